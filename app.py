@@ -1,168 +1,2383 @@
-from flask import Flask, render_template, request, redirect, url_for, send_file
+from flask import (Flask, render_template, request, redirect, url_for, send_file, make_response, abort,
+                   stream_with_context, has_request_context)
+from flask.cli import AppGroup
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
-import pandas as pd
-from io import BytesIO
+from sqlalchemy import event, inspect
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateColumn
+from werkzeug.http import is_resource_modified
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal, ROUND_HALF_UP
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import cnab
+import conciliacao
+import openpyxl
+from openpyxl.utils.exceptions import InvalidFileException
+import numpy as np
+import xlsxwriter
+import tempfile
+import click
+import functools
+import sqlite3
+import time
+import csv
+import io
 import os
+import json
+import multiprocessing
+import uuid
+import socket
+import zipfile
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///credito.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///credito.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['CONTRATOS_POR_PAGINA'] = 50
+app.config['CONTRATOS_POR_PAGINA_MAX'] = 500
+app.config['EXPORTACAO_LOTE'] = 5000
+# background exports: worker processes per web worker, where files go and how long they stay
+app.config['EXPORTACAO_PROCESSOS'] = 1
+app.config['EXPORTACAO_DIRETORIO'] = os.path.join(tempfile.gettempdir(), 'contratos_exportacoes')
+app.config['EXPORTACAO_RETENCAO_MINUTOS'] = 60
+app.config['EXPORTACAO_TEMPO_LIMITE_MINUTOS'] = 30
+app.config['EXPORTACAO_PARQUET_LINHAS_POR_GRUPO'] = 100000
+app.config['IMPORTACAO_LOTE'] = 2000
+app.config['IMPORTACAO_COMMIT_A_CADA'] = 10
+# beneficiary data of the collection agreement used in CNAB remittance files
+app.config['CNAB_CEDENTE'] = {
+    'banco': 0, 'nome_banco': '', 'cnpj': 0, 'nome': '', 'convenio': '',
+    'agencia': 0, 'agencia_dv': '', 'conta': 0, 'conta_dv': '', 'carteira': 1, 'especie': 2,
+}
+app.config['CNAB_LAYOUT'] = '240'
+app.config['CNAB_LOTE'] = 5000
+app.config['REMESSA_DIRETORIO'] = os.path.join(app.instance_path, 'remessas')
+# days around the due date within which a statement credit is matched by amount alone
+app.config['CONCILIACAO_JANELA_DIAS'] = 5
+app.config['MIGRAR_NA_INICIALIZACAO'] = os.environ.get('MIGRAR_NA_INICIALIZACAO', '1') != '0'
+# applied to every new SQLite connection; set to {} to keep SQLite's defaults
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000,
+}
+# FLASK_* environment variables override the settings above, e.g.
+# FLASK_CONTRATOS_POR_PAGINA=100 or FLASK_SQLITE_PRAGMAS='{"synchronous": "FULL"}'
+app.config.from_prefixed_env()
 db = SQLAlchemy(app)
 
+@event.listens_for(Engine, 'connect')
+def aplicar_pragmas_sqlite(conexao_dbapi, registro):
+    if not isinstance(conexao_dbapi, sqlite3.Connection):
+        return
+    cursor = conexao_dbapi.cursor()
+    for nome, valor in app.config['SQLITE_PRAGMAS'].items():
+        cursor.execute(f'PRAGMA {nome} = {valor}')
+    cursor.close()
+
+def _json_padrao(valor):
+    # ISO dates instead of Flask's HTTP dates; money as an exact string
+    if isinstance(valor, date):
+        return valor.isoformat()
+    if isinstance(valor, Decimal):
+        return str(valor)
+    return DefaultJSONProvider.default(valor)
+
+class ProvedorJSON(DefaultJSONProvider):
+    """Flask's JSON provider backed by orjson or msgspec when installed.
+
+    Dates come out as ISO strings and ``Decimal`` as a string with every
+    backend; without either library it falls back to the stdlib ``json``.
+    Responses are encoded straight to bytes.
+    """
+    default = staticmethod(_json_padrao)
+    ensure_ascii = False
+    # keep the column order of API objects
+    sort_keys = False
+
+    def __init__(self, app):
+        super().__init__(app)
+        self.codificador = msgspec.json.Encoder(enc_hook=_json_padrao) if msgspec else None
+
+    def codificar(self, obj, indentar=False):
+        if orjson is not None:
+            opcoes = orjson.OPT_NON_STR_KEYS
+            if indentar:
+                opcoes |= orjson.OPT_INDENT_2
+            if self.sort_keys:
+                opcoes |= orjson.OPT_SORT_KEYS
+            return orjson.dumps(obj, default=self.default, option=opcoes)
+        if self.codificador is not None and not indentar and not self.sort_keys:
+            return self.codificador.encode(obj)
+        separadores = None if indentar else (',', ':')
+        return super().dumps(obj, indent=2 if indentar else None, separators=separadores).encode()
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return self.codificar(obj).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indentar = self.compact is False or (self.compact is None and self._app.debug)
+        return self._app.response_class(self.codificar(obj, indentar), mimetype=self.mimetype)
+
+app.json = ProvedorJSON(app)
+
+UM_CENTAVO = Decimal(1)
+
+def agora_utc():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+class Centavos(db.TypeDecorator):
+    """Money stored as an integer number of cents and exposed as ``Decimal``.
+
+    Sums run as native integer ``SUM`` in SQLite and come back exact.
+    """
+    impl = db.Integer
+    cache_ok = True
+
+    @property
+    def python_type(self):
+        return Decimal
+
+    def process_bind_param(self, valor, dialect):
+        if valor is None:
+            return None
+        if not isinstance(valor, Decimal):
+            valor = Decimal(str(valor))
+        return int(valor.scaleb(2).quantize(UM_CENTAVO, ROUND_HALF_UP))
+
+    def process_result_value(self, valor, dialect):
+        return None if valor is None else Decimal(valor).scaleb(-2)
+
 class Contrato(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    cpf = db.Column(db.String(14), nullable=True)
-    data_contrato = db.Column(db.Date, nullable=True)
-    cliente = db.Column(db.String(100), nullable=True)
-    numero = db.Column(db.String(50), nullable=True)
+    cpf = db.Column(db.String(14), nullable=True, index=True)
+    data_contrato = db.Column(db.Date, nullable=True, index=True)
+    cliente = db.Column(db.String(100), nullable=True, index=True)
+    numero = db.Column(db.String(50), nullable=True, index=True)
     tipo_contrato = db.Column(db.String(50), nullable=True)
     cooperado = db.Column(db.String(100), nullable=True)
     garantia = db.Column(db.String(100), nullable=True)
-    valor_contrato_sistema = db.Column(db.Float, nullable=True)
+    valor_contrato_sistema = db.Column(Centavos, nullable=True)
     baixa_acima_48_meses = db.Column(db.Boolean, default=False)
-    valor_abatido = db.Column(db.Float, nullable=True)
-    ganho = db.Column(db.Float, nullable=True)
-    custas = db.Column(db.Float, nullable=True)
-    custas_deduzidas = db.Column(db.Float, nullable=True)
-    protesto = db.Column(db.Float, nullable=True)
-    protesto_deduzido = db.Column(db.Float, nullable=True)
-    honorario = db.Column(db.Float, nullable=True)
-    honorario_repassado = db.Column(db.Float, nullable=True)
-    alvara = db.Column(db.Float, nullable=True)
-    alvara_recebido = db.Column(db.Float, nullable=True)
-    valor_entrada = db.Column(db.Float, nullable=True)
+    valor_abatido = db.Column(Centavos, nullable=True)
+    ganho = db.Column(Centavos, nullable=True)
+    custas = db.Column(Centavos, nullable=True)
+    custas_deduzidas = db.Column(Centavos, nullable=True)
+    protesto = db.Column(Centavos, nullable=True)
+    protesto_deduzido = db.Column(Centavos, nullable=True)
+    honorario = db.Column(Centavos, nullable=True)
+    honorario_repassado = db.Column(Centavos, nullable=True)
+    alvara = db.Column(Centavos, nullable=True)
+    alvara_recebido = db.Column(Centavos, nullable=True)
+    valor_entrada = db.Column(Centavos, nullable=True)
     vencimento_entrada = db.Column(db.Date, nullable=True)
-    valor_das_parcelas = db.Column(db.Float, nullable=True)
+    valor_das_parcelas = db.Column(Centavos, nullable=True)
     parcelas = db.Column(db.Integer, default=0)
     parcelas_restantes = db.Column(db.Integer, default=0)
     vencimento_parcelas = db.Column(db.Date, nullable=True)
     quantidade_boletos_emitidos = db.Column(db.Integer, nullable=True)
-    valor_pg_com_boleto = db.Column(db.Float, nullable=True)
+    valor_pg_com_boleto = db.Column(Centavos, nullable=True)
     data_pg_boleto = db.Column(db.Date, nullable=True)
-    data_baixa = db.Column(db.Date, nullable=True)
+    data_baixa = db.Column(db.Date, nullable=True, index=True)
     obs_contabilidade = db.Column(db.Text, nullable=True)
     obs_contas_receber = db.Column(db.Text, nullable=True)
-    valor_repassar_escritorio = db.Column(db.Float, nullable=True)
+    valor_repassar_escritorio = db.Column(Centavos, nullable=True)
+    dias_atraso = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # UTC; set by the ORM on insert/update, set-based UPDATEs must set it themselves
+    atualizado_em = db.Column(db.DateTime, nullable=True, default=agora_utc, onupdate=agora_utc)
+
+class VersaoDados(db.Model):
+    """Single row whose counter is bumped by triggers on every write to contrato."""
+    __tablename__ = 'versao_dados'
+    id = db.Column(db.Integer, primary_key=True)
+    versao = db.Column(db.Integer, nullable=False, default=0)
+    atualizado_em = db.Column(db.DateTime, nullable=False, default=agora_utc)
+
+class AuditoriaContrato(db.Model):
+    """Append-only history of contract fields changed through the ORM, one row per field."""
+    __tablename__ = 'auditoria_contrato'
+    __table_args__ = (
+        db.Index('ix_auditoria_contrato_contrato', 'contrato_id', 'alterado_em'),
+        db.Index('ix_auditoria_contrato_alterado_em', 'alterado_em'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    # no foreign key: the history outlives a deleted contract
+    contrato_id = db.Column(db.Integer, nullable=False)
+    campo = db.Column(db.String(50), nullable=False)
+    valor_anterior = db.Column(db.Text, nullable=True)
+    valor_novo = db.Column(db.Text, nullable=True)
+    alterado_em = db.Column(db.DateTime, nullable=False)
+    usuario = db.Column(db.String(100), nullable=True)
+
+CAMPOS_SEM_AUDITORIA = {'id', 'atualizado_em'}
+
+def _valor_auditoria(valor, tipo):
+    if valor is None:
+        return None
+    if isinstance(tipo, Centavos):
+        return str(Decimal(str(valor)).quantize(Decimal('0.01'), ROUND_HALF_UP))
+    if isinstance(valor, (date, datetime)):
+        return valor.isoformat()
+    if isinstance(valor, bool):
+        return '1' if valor else '0'
+    return str(valor)
+
+def usuario_atual():
+    """Who is making the change: the authenticated user, else the client address; None outside a request."""
+    if not has_request_context():
+        return None
+    return request.remote_user or request.remote_addr
+
+@event.listens_for(db.session, 'before_flush')
+def registrar_alteracoes(sessao, contexto, instancias):
+    """Buffer one audit row per contract field whose value this flush changes."""
+    agora, usuario = agora_utc(), usuario_atual()
+    buffer = sessao.info.setdefault('auditoria', [])
+    for objeto in sessao.dirty:
+        if not isinstance(objeto, Contrato) or objeto.id is None:
+            continue
+        estado = inspect(objeto)
+        gravado = None
+        for atributo in estado.mapper.column_attrs:
+            if atributo.key in CAMPOS_SEM_AUDITORIA:
+                continue
+            historico = estado.attrs[atributo.key].history
+            if not historico.added:
+                continue
+            coluna = atributo.columns[0]
+            if historico.deleted:
+                anterior = historico.deleted[0]
+            else:
+                # assigned while expired: the old value is only in the database
+                if gravado is None:
+                    gravado = sessao.connection().execute(
+                        db.select(Contrato.__table__).where(Contrato.__table__.c.id == objeto.id)).one()._mapping
+                anterior = gravado[coluna]
+            anterior = _valor_auditoria(anterior, coluna.type)
+            novo = _valor_auditoria(historico.added[0], coluna.type)
+            if anterior != novo:
+                buffer.append({'contrato_id': objeto.id, 'campo': atributo.key, 'valor_anterior': anterior,
+                               'valor_novo': novo, 'alterado_em': agora, 'usuario': usuario})
+
+@event.listens_for(db.session, 'after_flush')
+def gravar_alteracoes(sessao, contexto):
+    """Write the buffered audit rows with one executemany, inside the flush's transaction."""
+    buffer = sessao.info.pop('auditoria', None)
+    if buffer:
+        sessao.connection().execute(db.insert(AuditoriaContrato), buffer)
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def descartar_alteracoes(sessao, transacao):
+    sessao.info.pop('auditoria', None)
+
+CAMPOS_RESUMO = ('valor_abatido', 'ganho', 'custas', 'honorario', 'alvara_recebido', 'valor_repassar_escritorio')
+
+class ResumoCarteira(db.Model):
+    """Portfolio totals per (tipo_contrato, cooperado), kept current by triggers on contrato."""
+    __tablename__ = 'resumo_carteira'
+    tipo_contrato = db.Column(db.String(50), primary_key=True)
+    cooperado = db.Column(db.String(100), primary_key=True)
+    contratos = db.Column(db.Integer, nullable=False, default=0)
+    valor_abatido = db.Column(Centavos, nullable=False, default=0)
+    ganho = db.Column(Centavos, nullable=False, default=0)
+    custas = db.Column(Centavos, nullable=False, default=0)
+    honorario = db.Column(Centavos, nullable=False, default=0)
+    alvara_recebido = db.Column(Centavos, nullable=False, default=0)
+    valor_repassar_escritorio = db.Column(Centavos, nullable=False, default=0)
+
+class TarefaExportacao(db.Model):
+    """One background export; ``chave`` identifies requests that produce the same file."""
+    __tablename__ = 'tarefa_exportacao'
+    __table_args__ = (
+        # at most one queued or running job per chave, even across web workers
+        db.Index('ux_tarefa_exportacao_ativa', 'chave', unique=True,
+                 sqlite_where=db.text("status IN ('pendente', 'executando')")),
+        db.Index('ix_tarefa_exportacao_chave_versao', 'chave', 'versao'),
+    )
+    id = db.Column(db.String(32), primary_key=True)
+    chave = db.Column(db.Text, nullable=False)
+    parametros = db.Column(db.Text, nullable=False)
+    # versao_dados when submitted; a finished file is reused while it is current
+    versao = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pendente')
+    caminho = db.Column(db.Text, nullable=True)
+    erro = db.Column(db.Text, nullable=True)
+    # 'host:pid' of the web worker that queued it, then of the pool process running it
+    dono = db.Column(db.String(100), nullable=True)
+    criada_em = db.Column(db.DateTime, nullable=False, default=agora_utc)
+    iniciada_em = db.Column(db.DateTime, nullable=True)
+    concluida_em = db.Column(db.DateTime, nullable=True)
+
+class Sequencia(db.Model):
+    """Named counters handed out in blocks with a single UPDATE ... RETURNING."""
+    nome = db.Column(db.String(50), primary_key=True)
+    valor = db.Column(db.Integer, nullable=False, default=0)
+
+class Remessa(db.Model):
+    """One CNAB remittance file; ``id`` is the file sequence number (NSA)."""
+    id = db.Column(db.Integer, primary_key=True)
+    layout = db.Column(db.String(3), nullable=False)
+    vencimento_de = db.Column(db.Date, nullable=False)
+    vencimento_ate = db.Column(db.Date, nullable=False)
+    gerada_em = db.Column(db.DateTime, nullable=False, default=agora_utc)
+    boletos = db.Column(db.Integer, nullable=False, default=0)
+    valor_total = db.Column(Centavos, nullable=False, default=0)
+    caminho = db.Column(db.Text, nullable=True)
+
+class Boleto(db.Model):
+    __table_args__ = (
+        # an installment is issued once; it survives a regenerated schedule
+        db.Index('ux_boleto_parcela', 'contrato_id', 'parcela_numero', unique=True),
+        db.Index('ux_boleto_nosso_numero', 'nosso_numero', unique=True),
+        db.Index('ix_boleto_remessa', 'remessa_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    remessa_id = db.Column(db.Integer, db.ForeignKey('remessa.id'), nullable=False)
+    contrato_id = db.Column(db.Integer, db.ForeignKey('contrato.id'), nullable=False)
+    parcela_numero = db.Column(db.Integer, nullable=False)
+    nosso_numero = db.Column(db.Integer, nullable=False)
+    vencimento = db.Column(db.Date, nullable=False)
+    valor = db.Column(Centavos, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='emitido')
+    valor_pago = db.Column(Centavos, nullable=True)
+    data_pagamento = db.Column(db.Date, nullable=True)
+
+class Extrato(db.Model):
+    """An imported bank statement; its credits are the LancamentoExtrato rows."""
+    id = db.Column(db.Integer, primary_key=True)
+    arquivo = db.Column(db.String(255), nullable=False)
+    importado_em = db.Column(db.DateTime, nullable=False, default=agora_utc)
+    lancamentos = db.Column(db.Integer, nullable=False, default=0)
+    propostos = db.Column(db.Integer, nullable=False, default=0)
+    confirmados = db.Column(db.Integer, nullable=False, default=0)
+
+class LancamentoExtrato(db.Model):
+    """A statement credit and the installment proposed for it (status proposto, confirmado or sem_par)."""
+    __tablename__ = 'lancamento_extrato'
+    __table_args__ = (db.Index('ix_lancamento_extrato_extrato_status', 'extrato_id', 'status'),)
+    id = db.Column(db.Integer, primary_key=True)
+    extrato_id = db.Column(db.Integer, db.ForeignKey('extrato.id'), nullable=False)
+    linha = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.Date, nullable=False)
+    valor = db.Column(Centavos, nullable=False)
+    descricao = db.Column(db.Text, nullable=True)
+    documento = db.Column(db.String(255), nullable=True)
+    contrato_id = db.Column(db.Integer, db.ForeignKey('contrato.id'), nullable=True)
+    parcela_numero = db.Column(db.Integer, nullable=True)
+    criterio = db.Column(db.String(10), nullable=True)
+    status = db.Column(db.String(20), nullable=False)
+
+class Parcela(db.Model):
+    __table_args__ = (
+        db.Index('ix_parcela_contrato_vencimento', 'contrato_id', 'vencimento'),
+        # covers the aging report, which only looks at unpaid installments
+        db.Index('ix_parcela_em_aberto', 'vencimento', 'contrato_id', 'valor', sqlite_where=db.text('quitada = 0')),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    contrato_id = db.Column(db.Integer, db.ForeignKey('contrato.id'), nullable=False)
+    numero = db.Column(db.Integer, nullable=False)
+    vencimento = db.Column(db.Date, nullable=False)
+    valor = db.Column(Centavos, nullable=True)
+    quitada = db.Column(db.Boolean, default=False, nullable=False)
+    data_pagamento = db.Column(db.Date, nullable=True)
+
+COLUNAS_EXPORTACAO = [
+    ('CPF','cpf'),('Cliente','cliente'),('Contrato','numero'),('Tipo','tipo_contrato'),
+    ('Cooperado','cooperado'),('Garantia','garantia'),('Valor Contrato Sistema','valor_contrato_sistema'),
+    ('Baixa >48m','baixa_acima_48_meses'),('Valor Abatido','valor_abatido'),('Ganho','ganho'),
+    ('Custas','custas'),('Custas Deduzidas','custas_deduzidas'),('Protesto','protesto'),
+    ('Protesto Deduzido','protesto_deduzido'),('Honorario','honorario'),
+    ('Honorario Repassado','honorario_repassado'),('Alvará','alvara'),
+    ('Alvará Recebido','alvara_recebido'),('Valor Entrada','valor_entrada'),
+    ('Vencimento Entrada','vencimento_entrada'),('Valor Parcelas','valor_das_parcelas'),
+    ('Parcelas','parcelas'),('Parcelas Restantes','parcelas_restantes'),
+    ('Vencimento Parcelas','vencimento_parcelas'),
+    ('Quantidade Boletos','quantidade_boletos_emitidos'),
+    ('Valor Pg Boleto','valor_pg_com_boleto'),
+    ('Data Pg Boleto','data_pg_boleto'),('Data Baixa','data_baixa'),
+    ('Obs Contabilidade','obs_contabilidade'),('Obs Contas Receber','obs_contas_receber'),
+    ('Valor Repassar Escritório','valor_repassar_escritorio')
+]
+
+VALORES_VERDADEIROS = {'1', 'true', 'verdadeiro', 'sim', 's', 'x', 'on'}
+
+def _vazio(valor):
+    return valor is None or (isinstance(valor, str) and not valor.strip())
+
+def _para_data(valor):
+    if isinstance(valor, datetime):
+        return valor.date()
+    if isinstance(valor, date):
+        return valor
+    if not isinstance(valor, str):
+        raise TypeError('data inválida (use AAAA-MM-DD ou DD/MM/AAAA)')
+    valor = valor.strip()
+    if len(valor) >= 10 and valor[4] == '-':
+        return date.fromisoformat(valor[:10])
+    try:
+        return datetime.strptime(valor, '%d/%m/%Y').date()
+    except ValueError:
+        raise ValueError('data inválida (use AAAA-MM-DD ou DD/MM/AAAA)') from None
+
+def _para_float(valor):
+    if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+        return float(valor)
+    if not isinstance(valor, str):
+        raise TypeError('número inválido')
+    valor = valor.strip()
+    try:
+        return float(valor)
+    except ValueError:
+        pass
+    try:
+        return float(valor.replace('.', '').replace(',', '.'))
+    except ValueError:
+        raise ValueError('número inválido') from None
+
+# largest amount whose cents fit the signed 64-bit INTEGER Centavos stores
+MAXIMO_CENTAVOS = Decimal(2 ** 63 - 1).scaleb(-2)
+
+def _para_decimal(valor):
+    if isinstance(valor, Decimal):
+        numero = valor
+    elif isinstance(valor, (int, float)) and not isinstance(valor, bool):
+        numero = Decimal(str(valor))
+    elif not isinstance(valor, str):
+        raise TypeError('valor inválido')
+    else:
+        valor = valor.strip()
+        if ',' in valor:
+            valor = valor.replace('.', '').replace(',', '.')
+        try:
+            numero = Decimal(valor)
+        except ArithmeticError:
+            raise ValueError('valor inválido') from None
+    if not numero.is_finite() or abs(numero) > MAXIMO_CENTAVOS:
+        raise ValueError('valor inválido')
+    return numero
+
+def _para_int(valor):
+    numero = _para_float(valor)
+    if not numero.is_integer() or abs(numero) >= 2 ** 63:
+        raise ValueError('número inteiro inválido')
+    return int(numero)
+
+def _para_bool(valor):
+    if isinstance(valor, str):
+        return valor.strip().lower() in VALORES_VERDADEIROS
+    return bool(valor)
+
+def _para_texto(limite):
+    def converter(valor):
+        texto = str(valor).strip()
+        if limite and len(texto) > limite:
+            raise ValueError(f'máximo de {limite} caracteres')
+        return texto
+    return converter
+
+# a schedule is generated in memory at once; 100 years of monthly installments
+MAXIMO_PARCELAS = 1200
+
+class EsquemaContrato:
+    """Coerces a form, spreadsheet row or JSON object into Contrato values in one pass.
+
+    One converter per column is chosen once from the column type, so every
+    entry point parses values the same way. ``coagir()`` returns
+    ``(valores, erros)`` with one message per invalid field instead of
+    stopping at the first one.
+    """
+
+    LIMITES = {'parcelas': (0, MAXIMO_PARCELAS), 'parcelas_restantes': (0, MAXIMO_PARCELAS)}
+
+    def __init__(self, tabela, campos):
+        self.conversores = {}
+        self.padroes = {}
+        self.mantem_se_vazio = set()
+        for campo in campos:
+            coluna = tabela.c[campo]
+            tipo = coluna.type.python_type
+            if tipo is date:
+                self.conversores[campo] = _para_data
+            elif tipo is bool:
+                self.conversores[campo] = _para_bool
+            elif tipo is int:
+                self.conversores[campo] = _para_int
+            elif tipo is Decimal:
+                self.conversores[campo] = _para_decimal
+            elif tipo is float:
+                self.conversores[campo] = _para_float
+            else:
+                self.conversores[campo] = _para_texto(getattr(coluna.type, 'length', None))
+            if tipo is not bool and tipo is not str:
+                self.mantem_se_vazio.add(campo)
+            if tipo is bool:
+                self.padroes[campo] = False
+            elif coluna.default is not None and coluna.default.is_scalar:
+                self.padroes[campo] = coluna.default.arg
+
+    def coagir(self, dados, parcial=False, campos=None, atual=None):
+        """Convert ``dados`` (any mapping with ``get``) for ``campos`` (default: all).
+
+        With ``parcial`` set, as for an edit, missing keys are left out of
+        the result and blank numbers and dates keep their current value,
+        while blank text clears the field and a blank flag means ``False``.
+        Otherwise missing or blank values become the column default or
+        ``None``. Installment counts are range-checked, and
+        ``parcelas_restantes`` may not exceed ``parcelas``, taken from
+        ``atual`` (the contract being edited) when not sent.
+        """
+        valores, erros = {}, {}
+        ausente = object()
+        for campo in campos or self.conversores:
+            bruto = dados.get(campo, ausente)
+            if bruto is ausente:
+                if parcial:
+                    continue
+                bruto = None
+            if _vazio(bruto):
+                if parcial and campo in self.mantem_se_vazio:
+                    continue
+                valores[campo] = self.padroes.get(campo)
+                continue
+            try:
+                valores[campo] = self.conversores[campo](bruto)
+            except (TypeError, ValueError) as erro:
+                erros[campo] = str(erro)
+        for campo, (minimo, maximo) in self.LIMITES.items():
+            if valores.get(campo) is not None and not minimo <= valores[campo] <= maximo:
+                erros[campo] = f'deve estar entre {minimo} e {maximo}'
+        if ('parcelas' in valores or 'parcelas_restantes' in valores) and not erros.keys() & self.LIMITES.keys():
+            quantidade = valores.get('parcelas', getattr(atual, 'parcelas', None))
+            restantes = valores.get('parcelas_restantes', getattr(atual, 'parcelas_restantes', None))
+            if quantidade is not None and restantes is not None and restantes > quantidade:
+                erros['parcelas_restantes'] = 'maior que o número de parcelas'
+        return valores, erros
+
+# every column a user may set; the rest are kept by the application
+ESQUEMA_CONTRATO = EsquemaContrato(Contrato.__table__, [coluna.name for coluna in Contrato.__table__.c
+                                                        if coluna.name not in ('id', 'dias_atraso', 'atualizado_em')])
+CAMPOS_EDICAO = [campo for campo in ESQUEMA_CONTRATO.conversores
+                 if campo not in ('cpf', 'data_contrato', 'cliente', 'numero', 'tipo_contrato')]
+
+MIGRACOES = []
+
+def migracao(funcao):
+    """Register ``funcao`` as the next schema version.
+
+    Migrations run in registration order and the number applied is kept in
+    SQLite's ``PRAGMA user_version``. Each one must be safe on a database
+    whose tables were just created from the current models.
+    """
+    MIGRACOES.append(funcao)
+    return funcao
+
+def versao_schema(conexao):
+    return conexao.exec_driver_sql('PRAGMA user_version').scalar()
+
+def aplicar_migracoes():
+    """Bring the database schema up to date; returns the versions applied."""
+    aplicadas = []
+    with db.engine.connect() as conexao:
+        versao = versao_schema(conexao)
+    for numero, funcao in enumerate(MIGRACOES[versao:], start=versao + 1):
+        with db.engine.begin() as conexao:
+            funcao(conexao)
+            conexao.exec_driver_sql(f'PRAGMA user_version = {numero}')
+        aplicadas.append((numero, funcao.__name__))
+    return aplicadas
+
+@migracao
+def criar_contrato(conexao):
+    Contrato.__table__.create(conexao, checkfirst=True)
+    # create(checkfirst=True) skips the indexes when the table already exists
+    for indice in Contrato.__table__.indexes:
+        indice.create(conexao, checkfirst=True)
+
+@migracao
+def criar_parcela(conexao):
+    Parcela.__table__.create(conexao, checkfirst=True)
+    for indice in Parcela.__table__.indexes:
+        indice.create(conexao, checkfirst=True)
+    gerar_parcelas(conexao)
+
+def _so_digitos(expressao):
+    return f"replace(replace(replace({expressao}, '.', ''), '-', ''), '/', '')"
+
+# contentless FTS5 index over the searchable columns; the CPF is indexed
+# without punctuation so '12345678900' and '123.456.789-00' both match
+SQL_BUSCA_CONTRATO = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS contrato_busca USING fts5("
+    "cliente, cpf, numero, cooperado, content='', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS contrato_busca_ai AFTER INSERT ON contrato BEGIN "
+    "INSERT INTO contrato_busca (rowid, cliente, cpf, numero, cooperado) "
+    f"VALUES (new.id, new.cliente, {_so_digitos('new.cpf')}, new.numero, new.cooperado); END",
+    "CREATE TRIGGER IF NOT EXISTS contrato_busca_ad AFTER DELETE ON contrato BEGIN "
+    "INSERT INTO contrato_busca (contrato_busca, rowid, cliente, cpf, numero, cooperado) "
+    f"VALUES ('delete', old.id, old.cliente, {_so_digitos('old.cpf')}, old.numero, old.cooperado); END",
+    "CREATE TRIGGER IF NOT EXISTS contrato_busca_au AFTER UPDATE OF cliente, cpf, numero, cooperado "
+    "ON contrato BEGIN "
+    "INSERT INTO contrato_busca (contrato_busca, rowid, cliente, cpf, numero, cooperado) "
+    f"VALUES ('delete', old.id, old.cliente, {_so_digitos('old.cpf')}, old.numero, old.cooperado); "
+    "INSERT INTO contrato_busca (rowid, cliente, cpf, numero, cooperado) "
+    f"VALUES (new.id, new.cliente, {_so_digitos('new.cpf')}, new.numero, new.cooperado); END",
+]
+
+@migracao
+def criar_busca_contrato(conexao):
+    existia = conexao.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE name = 'contrato_busca'").first() is not None
+    for sql in SQL_BUSCA_CONTRATO:
+        conexao.exec_driver_sql(sql)
+    if not existia:
+        conexao.exec_driver_sql(
+            "INSERT INTO contrato_busca (rowid, cliente, cpf, numero, cooperado) "
+            f"SELECT id, cliente, {_so_digitos('cpf')}, numero, cooperado FROM contrato")
+
+def _delta_resumo(linha, sinal):
+    """SQL applying the values of ``linha`` (``new``/``old``) to resumo_carteira with ``sinal``."""
+    campos = ', '.join(CAMPOS_RESUMO)
+    valores = ', '.join(f'{sinal}COALESCE({linha}.{campo}, 0)' for campo in CAMPOS_RESUMO)
+    somas = ', '.join(f'{campo} = {campo} + excluded.{campo}' for campo in ('contratos',) + CAMPOS_RESUMO)
+    return (f"INSERT INTO resumo_carteira (tipo_contrato, cooperado, contratos, {campos}) "
+            f"VALUES (COALESCE({linha}.tipo_contrato, ''), COALESCE({linha}.cooperado, ''), {sinal}1, {valores}) "
+            f"ON CONFLICT (tipo_contrato, cooperado) DO UPDATE SET {somas};")
+
+SQL_RESUMO_CARTEIRA = [
+    f"CREATE TRIGGER IF NOT EXISTS resumo_carteira_ai AFTER INSERT ON contrato BEGIN {_delta_resumo('new', '')} END",
+    f"CREATE TRIGGER IF NOT EXISTS resumo_carteira_ad AFTER DELETE ON contrato BEGIN {_delta_resumo('old', '-')} END",
+    f"CREATE TRIGGER IF NOT EXISTS resumo_carteira_au AFTER UPDATE OF tipo_contrato, cooperado, {', '.join(CAMPOS_RESUMO)} "
+    f"ON contrato BEGIN {_delta_resumo('old', '-')} {_delta_resumo('new', '')} END",
+]
+
+def reconstruir_resumo(conexao):
+    """Recompute resumo_carteira from scratch with one grouped scan of contrato."""
+    campos = ', '.join(CAMPOS_RESUMO)
+    somas = ', '.join(f'COALESCE(SUM({campo}), 0)' for campo in CAMPOS_RESUMO)
+    conexao.exec_driver_sql('DELETE FROM resumo_carteira')
+    conexao.exec_driver_sql(
+        f"INSERT INTO resumo_carteira (tipo_contrato, cooperado, contratos, {campos}) "
+        f"SELECT COALESCE(tipo_contrato, ''), COALESCE(cooperado, ''), COUNT(*), {somas} "
+        "FROM contrato GROUP BY 1, 2")
+
+@migracao
+def criar_resumo_carteira(conexao):
+    ResumoCarteira.__table__.create(conexao, checkfirst=True)
+    for sql in SQL_RESUMO_CARTEIRA:
+        conexao.exec_driver_sql(sql)
+    reconstruir_resumo(conexao)
+
+def colunas_existentes(conexao, tabela):
+    return {linha[1]: linha[2] for linha in conexao.exec_driver_sql(f'PRAGMA table_info({tabela})')}
+
+def reconstruir_tabela(conexao, tabela, expressoes):
+    """Recreate ``tabela`` from its current model definition, copying the rows over.
+
+    SQLite cannot change a column's type in place, so this follows the
+    create/copy/drop/rename procedure. ``expressoes`` maps column names to
+    the SQL used to convert the old value; other columns are copied as-is.
+    Indexes are recreated; triggers on the table are dropped with it.
+    """
+    existentes = colunas_existentes(conexao, tabela.name)
+    # the copy's foreign keys must resolve, so its MetaData gets the referenced tables too
+    metadata = db.MetaData()
+    for referida in {chave.column.table for chave in tabela.foreign_keys}:
+        referida.to_metadata(metadata)
+    nova = tabela.to_metadata(metadata, name=f'{tabela.name}_nova')
+    nova.indexes.clear()
+    nova.create(conexao)
+    colunas = [coluna.name for coluna in tabela.columns if coluna.name in existentes]
+    conexao.exec_driver_sql(
+        f"INSERT INTO {nova.name} ({', '.join(colunas)}) "
+        f"SELECT {', '.join(expressoes.get(coluna, coluna) for coluna in colunas)} FROM {tabela.name}")
+    conexao.exec_driver_sql(f'DROP TABLE {tabela.name}')
+    conexao.exec_driver_sql(f'ALTER TABLE {nova.name} RENAME TO {tabela.name}')
+    for indice in tabela.indexes:
+        indice.create(conexao)
+
+@migracao
+def valores_em_centavos(conexao):
+    """Store every money column as integer cents instead of REAL."""
+    convertidas = []
+    for tabela in (Contrato.__table__, Parcela.__table__):
+        existentes = colunas_existentes(conexao, tabela.name)
+        monetarias = [coluna.name for coluna in tabela.columns
+                      if isinstance(coluna.type, Centavos) and existentes.get(coluna.name, 'INTEGER') != 'INTEGER']
+        if monetarias:
+            reconstruir_tabela(conexao, tabela, {
+                coluna: f'CAST(ROUND({coluna} * 100) AS INTEGER)' for coluna in monetarias})
+            convertidas.append(tabela.name)
+    if convertidas == ['contrato']:
+        # parcela was created earlier in this same upgrade, from REAL amounts
+        # read as if they were cents; copy the converted amounts over
+        conexao.exec_driver_sql(
+            'UPDATE parcela SET valor = (SELECT valor_das_parcelas FROM contrato WHERE contrato.id = parcela.contrato_id)')
+    for sql in SQL_BUSCA_CONTRATO + SQL_RESUMO_CARTEIRA:
+        conexao.exec_driver_sql(sql)
+    ResumoCarteira.__table__.drop(conexao)
+    ResumoCarteira.__table__.create(conexao)
+    reconstruir_resumo(conexao)
+
+@migracao
+def indice_parcelas_em_aberto(conexao):
+    for indice in Parcela.__table__.indexes:
+        indice.create(conexao, checkfirst=True)
+
+def adicionar_coluna(conexao, coluna):
+    """ALTER TABLE ADD COLUMN for a model column, unless the table already has it."""
+    if coluna.name not in colunas_existentes(conexao, coluna.table.name):
+        ddl = CreateColumn(coluna).compile(dialect=conexao.dialect)
+        conexao.exec_driver_sql(f'ALTER TABLE {coluna.table.name} ADD COLUMN {ddl}')
+
+@migracao
+def contrato_dias_atraso(conexao):
+    adicionar_coluna(conexao, Contrato.__table__.c.dias_atraso)
+
+SQL_INCREMENTAR_VERSAO = "UPDATE versao_dados SET versao = versao + 1, atualizado_em = CURRENT_TIMESTAMP WHERE id = 1"
+
+SQL_VERSAO_DADOS = [
+    f"CREATE TRIGGER IF NOT EXISTS versao_dados_{sufixo} AFTER {operacao} ON contrato BEGIN "
+    f"{SQL_INCREMENTAR_VERSAO}; END"
+    for sufixo, operacao in (('ai', 'INSERT'), ('au', 'UPDATE'), ('ad', 'DELETE'))
+]
+
+@migracao
+def contrato_versao_dados(conexao):
+    adicionar_coluna(conexao, Contrato.__table__.c.atualizado_em)
+    VersaoDados.__table__.create(conexao, checkfirst=True)
+    conexao.exec_driver_sql(
+        "INSERT OR IGNORE INTO versao_dados (id, versao, atualizado_em) VALUES (1, 0, CURRENT_TIMESTAMP)")
+    for sql in SQL_VERSAO_DADOS:
+        conexao.exec_driver_sql(sql)
+
+@migracao
+def criar_tarefa_exportacao(conexao):
+    TarefaExportacao.__table__.create(conexao, checkfirst=True)
+    for indice in TarefaExportacao.__table__.indexes:
+        indice.create(conexao, checkfirst=True)
+
+@migracao
+def indices_filtros_exportacao(conexao):
+    for indice in Contrato.__table__.indexes:
+        indice.create(conexao, checkfirst=True)
+
+@migracao
+def criar_boletos(conexao):
+    for tabela in (Sequencia.__table__, Remessa.__table__, Boleto.__table__):
+        tabela.create(conexao, checkfirst=True)
+        for indice in tabela.indexes:
+            indice.create(conexao, checkfirst=True)
+
+@migracao
+def boleto_pagamento(conexao):
+    adicionar_coluna(conexao, Boleto.__table__.c.valor_pago)
+    adicionar_coluna(conexao, Boleto.__table__.c.data_pagamento)
+
+@migracao
+def criar_extratos(conexao):
+    for tabela in (Extrato.__table__, LancamentoExtrato.__table__):
+        tabela.create(conexao, checkfirst=True)
+        for indice in tabela.indexes:
+            indice.create(conexao, checkfirst=True)
+
+@migracao
+def criar_auditoria_contrato(conexao):
+    AuditoriaContrato.__table__.create(conexao, checkfirst=True)
+    for indice in AuditoriaContrato.__table__.indexes:
+        indice.create(conexao, checkfirst=True)
+
+@migracao
+def tarefa_exportacao_dono(conexao):
+    adicionar_coluna(conexao, TarefaExportacao.__table__.c.dono)
+
+db_cli = AppGroup('db', help='Schema do banco de dados.')
+
+@db_cli.command('upgrade')
+def db_upgrade():
+    """Apply pending schema migrations."""
+    aplicadas = aplicar_migracoes()
+    for numero, nome in aplicadas:
+        click.echo(f'{numero:04d} {nome}')
+    if not aplicadas:
+        click.echo('Schema já está atualizado.')
+
+@db_cli.command('current')
+def db_current():
+    """Show the current schema version."""
+    with db.engine.connect() as conexao:
+        click.echo(f'{versao_schema(conexao)} de {len(MIGRACOES)}')
+
+app.cli.add_command(db_cli)
+
+def cronograma_parcelas(ids, quantidades, restantes, valores, proximos_vencimentos):
+    """Build the installment schedules of many contracts at once.
+
+    All arguments are arrays aligned by contract. The first
+    ``quantidades - restantes`` installments are considered paid and the
+    next one is due on ``proximos_vencimentos``; every other installment is
+    a whole number of months before or after it, clamped to the last day of
+    shorter months. Returns one array per ``Parcela`` column, aligned by
+    installment.
+    """
+    quantidades = np.asarray(quantidades, dtype=np.int64)
+    restantes = np.clip(np.asarray(restantes, dtype=np.int64), 0, quantidades)
+    pagas = np.repeat(quantidades - restantes, quantidades)
+    proximos = np.asarray(proximos_vencimentos, dtype='datetime64[D]')
+    inicio = np.repeat(np.cumsum(quantidades) - quantidades, quantidades)
+    numero = np.arange(quantidades.sum()) - inicio + 1
+    proximo = np.repeat(proximos, quantidades)
+    mes_base = proximo.astype('datetime64[M]')
+    dia = proximo - mes_base.astype('datetime64[D]')
+    mes = mes_base + (numero - 1 - pagas)
+    ultimo_dia = (mes + 1).astype('datetime64[D]') - mes.astype('datetime64[D]') - 1
+    vencimento = mes.astype('datetime64[D]') + np.minimum(dia, ultimo_dia)
+    quitada = numero <= pagas
+    return (np.repeat(np.asarray(ids, dtype=np.int64), quantidades), numero, vencimento,
+            np.repeat(np.asarray(valores, dtype=float), quantidades), quitada)
+
+def gerar_parcelas(conexao, *filtros, lote=5000):
+    """Regenerate the Parcela rows of every contract matching ``filtros``.
+
+    Contracts are processed ``lote`` at a time: their old installments are
+    deleted and the new schedule is inserted with one executemany. Accepts
+    a Connection or a Session. Returns ``(contratos, parcelas)``. The data
+    version is bumped once at the end, since the triggers only watch
+    contrato and reports cached on it read parcela.
+    """
+    if not hasattr(conexao, 'exec_driver_sql'):
+        conexao = conexao.connection()
+    # read the installment amount as raw cents; they are written back as-is
+    colunas = (Contrato.id, Contrato.parcelas, Contrato.parcelas_restantes,
+               db.type_coerce(Contrato.valor_das_parcelas, db.Integer), Contrato.vencimento_parcelas)
+    ultimo, total_contratos, total_parcelas = 0, 0, 0
+    while True:
+        linhas = conexao.execute(
+            db.select(*colunas).where(Contrato.id > ultimo, *filtros).order_by(Contrato.id).limit(lote)
+        ).all()
+        if not linhas:
+            if total_contratos:
+                conexao.exec_driver_sql(SQL_INCREMENTAR_VERSAO)
+            return total_contratos, total_parcelas
+        ultimo = linhas[-1][0]
+        ids, quantidades, restantes, valores, vencimentos = zip(*linhas)
+        conexao.execute(db.delete(Parcela).where(Parcela.contrato_id.in_(ids)))
+        quantidades = np.array([q or 0 for q in quantidades])
+        quantidades[[v is None for v in vencimentos]] = 0
+        contrato_id, numero, vencimento, valor, quitada = cronograma_parcelas(
+            ids, quantidades, [r or 0 for r in restantes],
+            np.array(valores, dtype=float), [v or date.today() for v in vencimentos])
+        centavos = np.where(np.isnan(valor), None, np.nan_to_num(valor).astype(np.int64))
+        if len(numero):
+            conexao.exec_driver_sql(
+                'INSERT INTO parcela (contrato_id, numero, vencimento, valor, quitada) VALUES (?, ?, ?, ?, ?)',
+                list(zip(contrato_id.tolist(), numero.tolist(), vencimento.astype(str).tolist(),
+                         centavos.tolist(), quitada.tolist())))
+        total_contratos += len(linhas)
+        total_parcelas += len(numero)
+
+cobranca_cli = AppGroup('cobranca', help='Rotinas de cobrança.')
+
+@cobranca_cli.command('gerar-parcelas')
+def cobranca_gerar_parcelas():
+    """Regenerate the installment schedule of the whole portfolio."""
+    inicio = time.perf_counter()
+    contratos, parcelas = gerar_parcelas(db.session)
+    db.session.commit()
+    segundos = time.perf_counter() - inicio
+    click.echo(f'{parcelas} parcelas de {contratos} contratos geradas em {segundos:.2f}s')
+
+def recalcular_cobranca(sessao, hoje, lote=5000):
+    """Bring parcelas_restantes, vencimento_parcelas and dias_atraso in line with Parcela.
+
+    Runs one ``UPDATE ... FROM`` per range of ``lote`` contract ids,
+    aggregating that range's installments in SQL; no ORM objects are
+    loaded. Rows already correct are not written, so running it again for
+    the same day changes nothing. Yields ``(ultimo_id, atualizados)`` per
+    range so the caller can commit between ranges and report progress.
+    """
+    limites = sessao.execute(db.select(db.func.min(Contrato.id), db.func.max(Contrato.id))).one()
+    if limites[0] is None:
+        return
+    atraso = ("CASE WHEN a.proximo < :hoje "
+              "THEN CAST(julianday(:hoje) - julianday(a.proximo) AS INTEGER) ELSE 0 END")
+    sql = db.text(
+        "UPDATE contrato SET parcelas_restantes = a.restantes, "
+        "vencimento_parcelas = COALESCE(a.proximo, contrato.vencimento_parcelas), "
+        f"dias_atraso = {atraso}, atualizado_em = :agora "
+        "FROM (SELECT contrato_id, SUM(quitada = 0) AS restantes, "
+        "MIN(CASE WHEN quitada = 0 THEN vencimento END) AS proximo "
+        "FROM parcela WHERE contrato_id BETWEEN :inicio AND :fim GROUP BY contrato_id) AS a "
+        "WHERE contrato.id = a.contrato_id AND ("
+        "contrato.parcelas_restantes IS NOT a.restantes "
+        "OR contrato.vencimento_parcelas IS NOT COALESCE(a.proximo, contrato.vencimento_parcelas) "
+        f"OR contrato.dias_atraso IS NOT {atraso})")
+    for inicio in range(limites[0], limites[1] + 1, lote):
+        fim = inicio + lote - 1
+        resultado = sessao.execute(sql, {'hoje': hoje.isoformat(), 'agora': agora_utc(),
+                                         'inicio': inicio, 'fim': fim})
+        yield fim, resultado.rowcount
+
+@cobranca_cli.command('recalcular')
+@click.option('--data', 'hoje', type=click.DateTime(['%Y-%m-%d']), default=None,
+              help='Data de referência (padrão: hoje).')
+@click.option('--lote', type=int, default=5000, show_default=True, help='Contratos por UPDATE.')
+def cobranca_recalcular(hoje, lote):
+    """Recompute remaining installments, next due date and days overdue."""
+    hoje = hoje.date() if hoje else date.today()
+    inicio = time.perf_counter()
+    total = 0
+    for ultimo_id, atualizados in recalcular_cobranca(db.session, hoje, lote):
+        db.session.commit()
+        total += atualizados
+        app.logger.debug('recalcular: até id %s, %s atualizados', ultimo_id, atualizados)
+    segundos = time.perf_counter() - inicio
+    mensagem = (f'{total} contratos atualizados em {segundos:.2f}s '
+                f'({total / segundos if segundos else total:.0f} linhas/s), referência {hoje.isoformat()}')
+    app.logger.info(mensagem)
+    click.echo(mensagem)
+
+def reservar_sequencia(conexao, nome, quantidade):
+    """Reserve ``quantidade`` consecutive values of counter ``nome``; returns the first one."""
+    ultimo = conexao.execute(
+        sqlite_insert(Sequencia).values(nome=nome, valor=quantidade)
+        .on_conflict_do_update(index_elements=['nome'], set_={'valor': Sequencia.valor + quantidade})
+        .returning(Sequencia.valor)).scalar()
+    return ultimo - quantidade + 1
+
+def titulos_remessa(conexao, remessa_id, inicio, fim, lote):
+    """Issue boletos for the unpaid installments due from ``inicio`` to ``fim``.
+
+    Works ``lote`` installments at a time in (vencimento, id) order:
+    reserves a block of nosso números, inserts the Boleto rows and
+    yields one title per boleto for ``cnab.remessa()``. Installments that
+    already have a boleto are skipped.
+    """
+    colunas = (Parcela.id, Parcela.vencimento, db.type_coerce(Parcela.valor, db.Integer), Parcela.contrato_id,
+               Parcela.numero, Contrato.numero, Contrato.cliente, Contrato.cpf)
+    emitido = db.exists().where(Boleto.contrato_id == Parcela.contrato_id, Boleto.parcela_numero == Parcela.numero)
+    posicao = (inicio, 0)
+    while True:
+        linhas = conexao.execute(
+            db.select(*colunas).join(Contrato, Contrato.id == Parcela.contrato_id)
+            .where(Parcela.quitada == db.false(), Parcela.vencimento <= fim, Parcela.valor > 0,
+                   db.tuple_(Parcela.vencimento, Parcela.id) > posicao, ~emitido)
+            .order_by(Parcela.vencimento, Parcela.id).limit(lote)).all()
+        if not linhas:
+            return
+        posicao = (linhas[-1][1], linhas[-1][0])
+        primeiro = reservar_sequencia(conexao, 'nosso_numero', len(linhas))
+        conexao.exec_driver_sql(
+            'INSERT INTO boleto (remessa_id, contrato_id, parcela_numero, nosso_numero, vencimento, valor, status) '
+            "VALUES (?, ?, ?, ?, ?, ?, 'emitido')",
+            [(remessa_id, linha[3], linha[4], primeiro + i, linha[1].isoformat(), linha[2])
+             for i, linha in enumerate(linhas)])
+        for i, (_, vencimento, valor, contrato_id, parcela, numero, cliente, cpf) in enumerate(linhas):
+            yield {'nosso_numero': primeiro + i, 'documento': f'{numero or contrato_id}/{parcela}',
+                   'vencimento': vencimento, 'valor': valor, 'pagador_nome': cliente,
+                   'pagador_documento': cpf, 'uso_empresa': f'{contrato_id}-{parcela}'}
+
+def gerar_remessa(sessao, inicio, fim, layout=None):
+    """Issue boletos for the installments due in [``inicio``, ``fim``] and write the remittance file.
+
+    The file is streamed to ``REMESSA_DIRETORIO`` as the boletos are
+    created, so memory stays bounded by ``CNAB_LOTE``. Everything runs in
+    the caller's transaction; on failure the partial file is removed and
+    the caller should roll back. A range with nothing to issue raises
+    ``ValueError`` the same way, so no empty file takes up a sequence
+    number. Returns the Remessa.
+    """
+    layout = layout or app.config['CNAB_LAYOUT']
+    if layout not in ('240', '400'):
+        raise ValueError(f'layout CNAB desconhecido: {layout}')
+    remessa = Remessa(layout=layout, vencimento_de=inicio, vencimento_ate=fim)
+    sessao.add(remessa)
+    sessao.flush()
+    os.makedirs(app.config['REMESSA_DIRETORIO'], exist_ok=True)
+    caminho = os.path.join(app.config['REMESSA_DIRETORIO'], f'remessa_{remessa.id:06d}.rem')
+    conexao = sessao.connection()
+    titulos = titulos_remessa(conexao, remessa.id, inicio, fim, app.config['CNAB_LOTE'])
+    try:
+        with open(caminho, 'w', encoding='ascii', newline='') as arquivo:
+            arquivo.writelines(cnab.remessa(layout, app.config['CNAB_CEDENTE'], titulos, remessa.id, datetime.now()))
+    except BaseException:
+        os.remove(caminho)
+        raise
+    remessa.boletos, remessa.valor_total = conexao.execute(
+        db.select(db.func.count(), db.func.coalesce(db.func.sum(db.type_coerce(Boleto.valor, db.Integer)), 0))
+        .where(Boleto.remessa_id == remessa.id)).one()
+    if not remessa.boletos:
+        os.remove(caminho)
+        raise ValueError(f'nenhuma parcela a emitir com vencimento de {inicio:%d/%m/%Y} a {fim:%d/%m/%Y}')
+    # bump the boleto counters once, after every batch is in
+    conexao.execute(db.text(
+        'UPDATE contrato SET quantidade_boletos_emitidos = COALESCE(quantidade_boletos_emitidos, 0) + b.quantidade, '
+        'atualizado_em = :agora '
+        'FROM (SELECT contrato_id, COUNT(*) AS quantidade FROM boleto WHERE remessa_id = :remessa '
+        'GROUP BY contrato_id) AS b WHERE contrato.id = b.contrato_id'),
+        {'agora': agora_utc(), 'remessa': remessa.id})
+    remessa.valor_total = Decimal(remessa.valor_total).scaleb(-2)
+    remessa.caminho = caminho
+    return remessa
+
+@cobranca_cli.command('remessa')
+@click.option('--de', 'inicio', type=click.DateTime(['%Y-%m-%d']), required=True, help='Vencimento inicial.')
+@click.option('--ate', 'fim', type=click.DateTime(['%Y-%m-%d']), required=True, help='Vencimento final.')
+@click.option('--layout', type=click.Choice(['240', '400']), default=None, help='Layout CNAB (padrão: CNAB_LAYOUT).')
+def cobranca_remessa(inicio, fim, layout):
+    """Issue boletos for installments due in a date range and write the CNAB remittance file."""
+    comeco = time.perf_counter()
+    try:
+        remessa = gerar_remessa(db.session, inicio.date(), fim.date(), layout)
+        db.session.commit()
+    except ValueError as e:
+        db.session.rollback()
+        raise click.ClickException(str(e))
+    except BaseException:
+        db.session.rollback()
+        raise
+    segundos = time.perf_counter() - comeco
+    click.echo(f'Remessa {remessa.id}: {remessa.boletos} boletos, R$ {remessa.valor_total:.2f}, '
+               f'{segundos:.2f}s -> {remessa.caminho}')
+
+def aplicar_pagamentos(conexao, pagamentos):
+    """Record a batch of payments with one executemany per table.
+
+    ``pagamentos`` is a list of dicts with ``contrato_id``,
+    ``parcela_numero``, ``valor_pago`` (cents), ``data_pagamento`` and,
+    for boleto payments, ``boleto_id``. The installment is settled and the
+    contract's parcelas_restantes and vencimento_parcelas brought up to
+    date; boleto payments also mark the boleto paid and add to the
+    contract's valor_pg_com_boleto and data_pg_boleto. Runs in the
+    caller's transaction.
+    """
+    if not pagamentos:
+        return
+    boletos = [p for p in pagamentos if p.get('boleto_id')]
+    if boletos:
+        conexao.exec_driver_sql(
+            "UPDATE boleto SET status = 'pago', valor_pago = ?, data_pagamento = ? WHERE id = ?",
+            [(p['valor_pago'], p['data_pagamento'].isoformat(), p['boleto_id']) for p in boletos])
+    conexao.exec_driver_sql(
+        'UPDATE parcela SET quitada = 1, data_pagamento = ? WHERE contrato_id = ? AND numero = ? AND quitada = 0',
+        [(p['data_pagamento'].isoformat(), p['contrato_id'], p['parcela_numero']) for p in pagamentos])
+    # per contract: boleto total and latest boleto date, None when it had no boleto payment
+    contratos = dict.fromkeys((p['contrato_id'] for p in pagamentos), (None, None))
+    for p in boletos:
+        valor, data = contratos[p['contrato_id']]
+        contratos[p['contrato_id']] = ((valor or 0) + p['valor_pago'], max(data or p['data_pagamento'], p['data_pagamento']))
+    agora = agora_utc()
+    conexao.exec_driver_sql(
+        'UPDATE contrato SET valor_pg_com_boleto = COALESCE(valor_pg_com_boleto + ?, ?, valor_pg_com_boleto), '
+        'data_pg_boleto = COALESCE(MAX(data_pg_boleto, ?), ?, data_pg_boleto), '
+        'parcelas_restantes = (SELECT COUNT(*) FROM parcela WHERE contrato_id = contrato.id AND quitada = 0), '
+        'vencimento_parcelas = COALESCE((SELECT MIN(vencimento) FROM parcela '
+        'WHERE contrato_id = contrato.id AND quitada = 0), vencimento_parcelas), '
+        'atualizado_em = ? WHERE id = ?',
+        [(valor, valor, data and data.isoformat(), data and data.isoformat(), agora, contrato_id)
+         for contrato_id, (valor, data) in contratos.items()])
+
+def processar_retorno(conexao, linhas, lote=5000):
+    """Settle the boletos paid in a CNAB return file and report what did not match.
+
+    Occurrences are read lazily from ``linhas`` and handled ``lote`` at a
+    time: one lookup on the unique nosso_numero index builds a dict of
+    that batch's boletos, each payment is matched against it, and the
+    matched ones go to ``aplicar_pagamentos``. Payments for unknown
+    nosso números and repeated or already paid boletos are left out and
+    listed in the report. Runs in the caller's transaction.
+    """
+    relatorio = {'ocorrencias': 0, 'ignoradas': 0, 'baixados': 0, 'valor': 0,
+                 'nao_encontrados': [], 'duplicados': []}
+    vistos = set()
+
+    def conciliar(liquidacoes):
+        numeros = {item['nosso_numero'] for item in liquidacoes}
+        boletos = {linha.nosso_numero: linha for linha in conexao.execute(
+            db.select(Boleto.nosso_numero, Boleto.id, Boleto.contrato_id, Boleto.parcela_numero, Boleto.status)
+            .where(Boleto.nosso_numero.in_(numeros)))}
+        pagamentos = []
+        for item in liquidacoes:
+            boleto = boletos.get(item['nosso_numero'])
+            if boleto is None:
+                relatorio['nao_encontrados'].append(item)
+            elif boleto.status == 'pago' or item['nosso_numero'] in vistos:
+                relatorio['duplicados'].append(item)
+            else:
+                vistos.add(item['nosso_numero'])
+                pagamentos.append({'boleto_id': boleto.id, 'contrato_id': boleto.contrato_id,
+                                   'parcela_numero': boleto.parcela_numero, 'valor_pago': item['valor_pago'],
+                                   'data_pagamento': item['data_pagamento'] or date.today()})
+        aplicar_pagamentos(conexao, pagamentos)
+        relatorio['baixados'] += len(pagamentos)
+        relatorio['valor'] += sum(p['valor_pago'] for p in pagamentos)
+
+    liquidacoes = []
+    for item in cnab.retorno(linhas):
+        relatorio['ocorrencias'] += 1
+        if item['ocorrencia'] not in cnab.OCORRENCIAS_LIQUIDACAO:
+            relatorio['ignoradas'] += 1
+        elif item['nosso_numero'] is None:
+            relatorio['nao_encontrados'].append(item)
+        else:
+            liquidacoes.append(item)
+            if len(liquidacoes) == lote:
+                conciliar(liquidacoes)
+                liquidacoes = []
+    if liquidacoes:
+        conciliar(liquidacoes)
+    relatorio['valor'] = Decimal(relatorio['valor']).scaleb(-2)
+    return relatorio
+
+@cobranca_cli.command('retorno')
+@click.argument('caminho', type=click.Path(exists=True, dir_okay=False))
+@click.option('--simular', is_flag=True, help='Mostra o resultado sem gravar.')
+def cobranca_retorno(caminho, simular):
+    """Settle the boletos paid in a CNAB 240/400 return file."""
+    comeco = time.perf_counter()
+    try:
+        with open(caminho, encoding='latin-1', newline='') as arquivo:
+            relatorio = processar_retorno(db.session.connection(), arquivo, app.config['CNAB_LOTE'])
+        if simular:
+            db.session.rollback()
+        else:
+            db.session.commit()
+    except BaseException:
+        db.session.rollback()
+        raise
+    segundos = time.perf_counter() - comeco
+    click.echo(f"{relatorio['ocorrencias']} ocorrências em {segundos:.2f}s: {relatorio['baixados']} boletos baixados "
+               f"(R$ {relatorio['valor']:.2f}), {relatorio['ignoradas']} ignoradas, "
+               f"{len(relatorio['nao_encontrados'])} não encontradas, {len(relatorio['duplicados'])} duplicadas"
+               + (' [simulação, nada gravado]' if simular else ''))
+    for motivo in ('nao_encontrados', 'duplicados'):
+        for item in relatorio[motivo]:
+            click.echo(f"  {motivo}: linha {item['linha']}, nosso número {item['nosso_numero']}, "
+                       f"R$ {Decimal(item['valor_pago']).scaleb(-2):.2f}")
 
-@app.before_request
-def before_request():
-    db.create_all()
+SQL_CPF_NORMALIZADO = "replace(replace(replace(contrato.cpf, '.', ''), '-', ''), '/', '')"
+
+def importar_extrato(sessao, linhas, nome):
+    """Import a bank statement and propose the installment each credit pays.
+
+    The credits are read into memory first. Their CPFs/CNPJs and words
+    select, in one scan of contrato, the contracts they may name; their
+    amounts and date range select the open installments that can match:
+    any of the named contracts' installments due up to the last credit
+    (plus the matching window), and every other installment due within
+    the window of the credits. Those are loaded into a
+    ``conciliacao.Conciliador`` and every credit is matched in a single
+    pass; credits and proposals are stored for review with one
+    executemany. Runs in the caller's transaction. Returns the Extrato.
+    """
+    lancamentos = list(conciliacao.ler_extrato(linhas, nome))
+    if not lancamentos:
+        raise ValueError('Nenhum crédito encontrado no extrato.')
+    extrato = Extrato(arquivo=nome)
+    sessao.add(extrato)
+    sessao.flush()
+    conexao = sessao.connection()
+    conciliador = conciliacao.Conciliador(app.config['CONCILIACAO_JANELA_DIAS'])
+
+    chaves, valores = set(), set()
+    for lancamento in lancamentos:
+        chaves |= lancamento['documentos'] | lancamento['palavras']
+        valores.add(lancamento['valor'])
+    for tabela, itens in (('chave_conciliacao', chaves), ('valor_conciliacao', valores)):
+        conexao.exec_driver_sql(f'CREATE TEMP TABLE IF NOT EXISTS {tabela} (chave PRIMARY KEY)')
+        conexao.exec_driver_sql(f'DELETE FROM {tabela}')
+        if itens:
+            conexao.exec_driver_sql(f'INSERT INTO {tabela} VALUES (?)', [(item,) for item in itens])
+    nomeados = (f'FROM contrato WHERE {SQL_CPF_NORMALIZADO} IN (SELECT chave FROM chave_conciliacao) '
+                'OR upper(trim(numero)) IN (SELECT chave FROM chave_conciliacao)')
+    for contrato_id, cpf, numero in conexao.exec_driver_sql(f'SELECT id, cpf, numero {nomeados}'):
+        conciliador.adicionar_contrato(contrato_id, cpf, numero)
+
+    janela = timedelta(days=app.config['CONCILIACAO_JANELA_DIAS'])
+    datas = [lancamento['data'] for lancamento in lancamentos]
+    for contrato_id, numero, vencimento, valor in conexao.exec_driver_sql(
+            'SELECT contrato_id, numero, vencimento, valor FROM parcela '
+            'WHERE quitada = 0 AND vencimento <= ? AND valor IN (SELECT chave FROM valor_conciliacao) '
+            f'AND (vencimento >= ? OR contrato_id IN (SELECT id {nomeados}))',
+            ((max(datas) + janela).isoformat(), (min(datas) - janela).isoformat())).all():
+        conciliador.adicionar_parcela((contrato_id, numero), contrato_id, date.fromisoformat(vencimento), valor)
+
+    linhas_extrato = []
+    for lancamento in lancamentos:
+        proposta = conciliador.propor(lancamento)
+        (contrato_id, parcela_numero), criterio = proposta or ((None, None), None)
+        linhas_extrato.append((extrato.id, lancamento['linha'], lancamento['data'].isoformat(), lancamento['valor'],
+                               lancamento['descricao'], lancamento['documento'], contrato_id, parcela_numero,
+                               criterio, 'proposto' if proposta else 'sem_par'))
+    conexao.exec_driver_sql(
+        'INSERT INTO lancamento_extrato (extrato_id, linha, data, valor, descricao, documento, contrato_id, '
+        'parcela_numero, criterio, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', linhas_extrato)
+    extrato.lancamentos = len(linhas_extrato)
+    extrato.propostos = len(conciliador.propostas)
+    return extrato
+
+def confirmar_extrato(sessao, extrato, ids=None):
+    """Apply the proposed matches of ``extrato`` (only ``ids``, when given) as payments; returns how many."""
+    conexao = sessao.connection()
+    consulta = (db.select(LancamentoExtrato.id, LancamentoExtrato.contrato_id, LancamentoExtrato.parcela_numero,
+                          db.type_coerce(LancamentoExtrato.valor, db.Integer), LancamentoExtrato.data)
+                .where(LancamentoExtrato.extrato_id == extrato.id, LancamentoExtrato.status == 'proposto'))
+    ids = None if ids is None else sorted(set(ids))
+    grupos = [consulta] if ids is None else [
+        consulta.where(LancamentoExtrato.id.in_(ids[i:i + 5000])) for i in range(0, len(ids), 5000)]
+    total = 0
+    for grupo in grupos:
+        linhas = conexao.execute(grupo).all()
+        if not linhas:
+            continue
+        aplicar_pagamentos(conexao, [{'contrato_id': contrato_id, 'parcela_numero': parcela_numero,
+                                      'valor_pago': valor, 'data_pagamento': data}
+                                     for _, contrato_id, parcela_numero, valor, data in linhas])
+        conexao.exec_driver_sql("UPDATE lancamento_extrato SET status = 'confirmado' WHERE id = ?",
+                                [(linha[0],) for linha in linhas])
+        total += len(linhas)
+    extrato.confirmados += total
+    return total
+
+@cobranca_cli.command('conciliar')
+@click.argument('caminho', type=click.Path(exists=True, dir_okay=False))
+@click.option('--confirmar', is_flag=True, help='Aplica todas as correspondências propostas.')
+def cobranca_conciliar(caminho, confirmar):
+    """Match the credits of an OFX/CSV bank statement against open installments."""
+    comeco = time.perf_counter()
+    try:
+        with open(caminho, encoding='utf-8-sig', errors='replace', newline='') as arquivo:
+            extrato = importar_extrato(db.session, arquivo, os.path.basename(caminho))
+        if confirmar:
+            confirmar_extrato(db.session, extrato)
+        db.session.commit()
+    except BaseException:
+        db.session.rollback()
+        raise
+    segundos = time.perf_counter() - comeco
+    click.echo(f'Extrato {extrato.id}: {extrato.lancamentos} créditos, {extrato.propostos} correspondências '
+               f'propostas, {extrato.confirmados} confirmadas em {segundos:.2f}s')
+
+@cobranca_cli.command('reconstruir-resumo')
+def cobranca_reconstruir_resumo():
+    """Rebuild the portfolio summary table from the contracts."""
+    reconstruir_resumo(db.session.connection())
+    db.session.commit()
+    click.echo('Resumo da carteira reconstruído.')
+
+app.cli.add_command(cobranca_cli)
+
+def pagina_keyset(consulta, coluna, apos=None, antes=None, por_pagina=50, ordem=None):
+    """Fetch one page ordered by ``coluna`` using the last/first seen key.
+
+    Returns ``(itens, anterior, proximo)`` where ``anterior``/``proximo`` are
+    the cursors for the previous/next page, or ``None`` at either end.
+    ``ordem`` sorts by several columns instead, the last being the unique
+    ``coluna``; cursors are still ``coluna`` values, looked up for the
+    rest of the key.
+    """
+    if ordem:
+        chave = db.tuple_(*ordem)
+
+        def posicao(cursor):
+            linha = db.session.execute(db.select(*ordem).where(coluna == cursor)).first()
+            return db.tuple_(*linha) if linha is not None else None
+    else:
+        ordem, chave, posicao = [coluna], coluna, lambda cursor: cursor
+    if antes is not None:
+        antes = posicao(antes)
+        if antes is None:
+            return [], None, None
+        itens = (consulta.filter(chave < antes).order_by(*(parte.desc() for parte in ordem))
+                 .limit(por_pagina + 1).all())
+        tem_anterior = len(itens) > por_pagina
+        itens = itens[:por_pagina][::-1]
+        if not itens:
+            return itens, None, None
+        return itens, (itens[0].id if tem_anterior else None), itens[-1].id
+    if apos is not None:
+        inicio = posicao(apos)
+        if inicio is None:
+            return [], None, None
+        consulta = consulta.filter(chave > inicio)
+    itens = consulta.order_by(*ordem).limit(por_pagina + 1).all()
+    tem_proximo = len(itens) > por_pagina
+    itens = itens[:por_pagina]
+    if not itens:
+        return itens, None, None
+    return itens, (itens[0].id if apos is not None else None), (itens[-1].id if tem_proximo else None)
+
+COLUNAS_BUSCA = ('cliente', 'cpf', 'numero', 'cooperado')
+
+def filtros_busca(texto, colunas=COLUNAS_BUSCA):
+    """Translate a free-text search into filters on Contrato.
+
+    Words of three or more characters go to the trigram index, so any
+    substring of ``colunas`` (some of cliente, CPF, numero and cooperado)
+    matches; shorter words fall back to a LIKE scan. Every word must match.
+    """
+    longos, filtros = [], []
+    for termo in texto.split():
+        if len(termo) >= 3:
+            alternativas = {termo}
+            if termo.strip('0123456789.-/') == '':
+                alternativas.add(termo.replace('.', '').replace('-', '').replace('/', ''))
+            longos.append('(' + ' OR '.join('"%s"' % a.replace('"', '""') for a in alternativas if len(a) >= 3) + ')')
+        else:
+            padrao = f'%{termo}%'
+            filtros.append(db.or_(*(getattr(Contrato, coluna).ilike(padrao) for coluna in colunas)))
+    if longos:
+        busca = ' AND '.join(longos)
+        if tuple(colunas) != COLUNAS_BUSCA:
+            busca = '{%s} : (%s)' % (' '.join(colunas), busca)
+        filtros.append(Contrato.id.in_(
+            db.select(db.literal_column('rowid')).select_from(db.table('contrato_busca'))
+            .where(db.text('contrato_busca MATCH :busca').bindparams(busca=busca))))
+    return filtros
+
+def por_pagina_solicitado():
+    por_pagina = request.args.get('por_pagina', app.config['CONTRATOS_POR_PAGINA'], type=int)
+    return max(1, min(por_pagina, app.config['CONTRATOS_POR_PAGINA_MAX']))
+
+def resposta_condicional(etag, ultima_modificacao, renderizar):
+    """Answer 304 if the client's copy matches ``etag``, otherwise call ``renderizar``.
+
+    The validators are checked before ``renderizar`` runs, so a
+    revalidation costs one indexed lookup and no ORM or template work.
+    """
+    if is_resource_modified(request.environ, etag=etag, last_modified=ultima_modificacao):
+        resposta = make_response(renderizar())
+    else:
+        resposta = app.response_class(status=304)
+    resposta.set_etag(etag)
+    resposta.last_modified = ultima_modificacao
+    # let browsers keep the page but revalidate it on every visit
+    resposta.cache_control.no_cache = True
+    return resposta
+
+def versao_atual():
+    return db.session.execute(
+        db.select(VersaoDados.versao, VersaoDados.atualizado_em).where(VersaoDados.id == 1)).one()
 
 @app.route('/')
 def index():
-    contratos = Contrato.query.all()
-    return render_template('index.html', contratos=contratos)
+    def listar():
+        por_pagina = por_pagina_solicitado()
+        busca = request.args.get('q', '').strip()
+        consulta = Contrato.query.options(db.load_only(
+            Contrato.cpf, Contrato.cliente, Contrato.numero, Contrato.tipo_contrato))
+        if busca:
+            consulta = consulta.filter(*filtros_busca(busca))
+        contratos, anterior, proximo = pagina_keyset(
+            consulta, Contrato.id,
+            apos=request.args.get('apos', type=int),
+            antes=request.args.get('antes', type=int),
+            por_pagina=por_pagina)
+        return render_template('index.html', contratos=contratos, anterior=anterior,
+                               proximo=proximo, por_pagina=por_pagina, busca=busca)
+    versao, atualizado_em = versao_atual()
+    return resposta_condicional(f'v{versao}', atualizado_em, listar)
+
+FAIXAS_ATRASO = (('0-30', 30), ('31-60', 60), ('61-90', 90), ('90+', None))
+
+@functools.lru_cache(maxsize=4)
+def relatorio_aging(hoje, versao):
+    """Overdue installments per (cooperado, tipo_contrato, faixa) as of ``hoje``.
+
+    One grouped query over the unpaid installments already due, served by
+    the partial index ``ix_parcela_em_aberto``. Cached per day and data
+    version: pass ``date.today()`` and ``versao_atual().versao``, so a new
+    day or any write to contrato (settling an installment updates its
+    contract) means a new key, in every worker.
+    """
+    # compare against each bucket's cutoff date instead of computing day counts per row
+    faixa = db.case(*[(Parcela.vencimento >= hoje - timedelta(days=limite), rotulo)
+                      for rotulo, limite in FAIXAS_ATRASO if limite],
+                    else_=FAIXAS_ATRASO[-1][0]).label('faixa')
+    cooperado = db.func.coalesce(Contrato.cooperado, '').label('cooperado')
+    tipo_contrato = db.func.coalesce(Contrato.tipo_contrato, '').label('tipo_contrato')
+    consulta = (
+        db.select(cooperado, tipo_contrato, faixa,
+                  db.func.count().label('parcelas'),
+                  db.func.coalesce(db.func.sum(Parcela.valor), 0).label('valor'))
+        .join(Contrato, Contrato.id == Parcela.contrato_id)
+        .where(Parcela.quitada == db.false(), Parcela.vencimento < hoje)
+        .group_by(cooperado, tipo_contrato, faixa)
+        .order_by(cooperado, tipo_contrato)
+    )
+    return tuple(db.session.execute(consulta).all())
+
+@app.route('/relatorios/aging')
+def aging():
+    hoje = date.today()
+    faixas = [rotulo for rotulo, _ in FAIXAS_ATRASO]
+    grupos, totais = {}, {rotulo: [0, Decimal(0)] for rotulo in faixas}
+    for linha in relatorio_aging(hoje, versao_atual().versao):
+        celula = grupos.setdefault((linha.cooperado, linha.tipo_contrato), {}).setdefault(linha.faixa, [0, Decimal(0)])
+        celula[0] += linha.parcelas
+        celula[1] += linha.valor
+        totais[linha.faixa][0] += linha.parcelas
+        totais[linha.faixa][1] += linha.valor
+    return render_template('aging.html', hoje=hoje, faixas=faixas, grupos=grupos, totais=totais)
+
+@app.route('/painel')
+def painel():
+    """Portfolio totals read from resumo_carteira, independent of the number of contracts."""
+    colunas = [db.func.sum(ResumoCarteira.contratos).label('contratos')] + [
+        db.func.sum(getattr(ResumoCarteira, campo)).label(campo) for campo in CAMPOS_RESUMO]
+    ativos = ResumoCarteira.contratos > 0
+    por_tipo = db.session.execute(
+        db.select(ResumoCarteira.tipo_contrato, *colunas).where(ativos)
+        .group_by(ResumoCarteira.tipo_contrato).order_by(ResumoCarteira.tipo_contrato)).all()
+    por_cooperado = db.session.execute(
+        db.select(ResumoCarteira.cooperado, *colunas).where(ativos)
+        .group_by(ResumoCarteira.cooperado).order_by(ResumoCarteira.cooperado)).all()
+    total = db.session.execute(db.select(*colunas).where(ativos)).one()
+    return render_template('painel.html', por_tipo=por_tipo, por_cooperado=por_cooperado,
+                           total=total, campos=CAMPOS_RESUMO)
 
 @app.route('/novo', methods=['GET', 'POST'])
 def novo():
     if request.method == 'POST':
-        c = Contrato(
-            cpf=request.form.get('cpf'),
-            data_contrato=datetime.strptime(request.form.get('data_contrato'), '%Y-%m-%d') if request.form.get('data_contrato') else None,
-            cliente=request.form.get('cliente'),
-            numero=request.form.get('numero'),
-            tipo_contrato=request.form.get('tipo_contrato'),
-            cooperado=request.form.get('cooperado'),
-            garantia=request.form.get('garantia'),
-            valor_contrato_sistema=float(request.form.get('valor_contrato_sistema')) if request.form.get('valor_contrato_sistema') else None,
-            baixa_acima_48_meses=bool(request.form.get('baixa_acima_48_meses')),
-            valor_abatido=float(request.form.get('valor_abatido')) if request.form.get('valor_abatido') else None,
-            ganho=float(request.form.get('ganho')) if request.form.get('ganho') else None,
-            custas=float(request.form.get('custas')) if request.form.get('custas') else None,
-            custas_deduzidas=float(request.form.get('custas_deduzidas')) if request.form.get('custas_deduzidas') else None,
-            protesto=float(request.form.get('protesto')) if request.form.get('protesto') else None,
-            protesto_deduzido=float(request.form.get('protesto_deduzido')) if request.form.get('protesto_deduzido') else None,
-            honorario=float(request.form.get('honorario')) if request.form.get('honorario') else None,
-            honorario_repassado=float(request.form.get('honorario_repassado')) if request.form.get('honorario_repassado') else None,
-            alvara=float(request.form.get('alvara')) if request.form.get('alvara') else None,
-            alvara_recebido=float(request.form.get('alvara_recebido')) if request.form.get('alvara_recebido') else None,
-            valor_entrada=float(request.form.get('valor_entrada')) if request.form.get('valor_entrada') else None,
-            vencimento_entrada=datetime.strptime(request.form.get('vencimento_entrada'), '%Y-%m-%d') if request.form.get('vencimento_entrada') else None,
-            valor_das_parcelas=float(request.form.get('valor_das_parcelas')) if request.form.get('valor_das_parcelas') else None,
-            parcelas=int(request.form.get('parcelas')) if request.form.get('parcelas') else 0,
-            parcelas_restantes=int(request.form.get('parcelas_restantes')) if request.form.get('parcelas_restantes') else 0,
-            vencimento_parcelas=datetime.strptime(request.form.get('vencimento_parcelas'), '%Y-%m-%d') if request.form.get('vencimento_parcelas') else None,
-            quantidade_boletos_emitidos=int(request.form.get('quantidade_boletos_emitidos')) if request.form.get('quantidade_boletos_emitidos') else None,
-            valor_pg_com_boleto=float(request.form.get('valor_pg_com_boleto')) if request.form.get('valor_pg_com_boleto') else None,
-            data_pg_boleto=datetime.strptime(request.form.get('data_pg_boleto'), '%Y-%m-%d') if request.form.get('data_pg_boleto') else None,
-            data_baixa=datetime.strptime(request.form.get('data_baixa'), '%Y-%m-%d') if request.form.get('data_baixa') else None,
-            obs_contabilidade=request.form.get('obs_contabilidade'),
-            obs_contas_receber=request.form.get('obs_contas_receber'),
-            valor_repassar_escritorio=float(request.form.get('valor_repassar_escritorio')) if request.form.get('valor_repassar_escritorio') else None
-        )
+        valores, erros = ESQUEMA_CONTRATO.coagir(request.form)
+        if erros:
+            return render_template('novo.html', erros=erros, dados=request.form), 400
+        c = Contrato(**valores)
         db.session.add(c)
+        db.session.flush()
+        gerar_parcelas(db.session, Contrato.id == c.id)
         db.session.commit()
         return redirect(url_for('index'))
-    return render_template('novo.html')
+    return render_template('novo.html', erros={}, dados={})
+
+def validadores_contrato(id):
+    """``(etag, ultima_modificacao)`` of one contract, or ``None`` if it does not exist."""
+    linha = db.session.execute(db.select(Contrato.atualizado_em).where(Contrato.id == id)).first()
+    if linha is None:
+        return None
+    if linha.atualizado_em is None:
+        # written before the column existed: fall back to the global counter
+        versao, atualizado_em = versao_atual()
+        return f'c{id}-v{versao}', atualizado_em
+    return f'c{id}-{linha.atualizado_em.isoformat()}', linha.atualizado_em
+
+def _valor_comparavel(valor, tipo):
+    # text as the schema coerces it: stripped, and blank the same as NULL
+    if tipo.python_type is str:
+        return (valor or '').strip() or None
+    return _valor_auditoria(valor, tipo)
+
+def diferencas_contrato(c, valores):
+    """The entries of coerced ``valores`` that differ from what ``c`` holds, compared as stored (money to the cent)."""
+    return {campo: valor for campo, valor in valores.items()
+            if _valor_comparavel(getattr(c, campo), getattr(Contrato, campo).type)
+            != _valor_comparavel(valor, getattr(Contrato, campo).type)}
+
+CAMPOS_CRONOGRAMA = {'parcelas', 'parcelas_restantes', 'valor_das_parcelas', 'vencimento_parcelas'}
+
+def atualizar_contrato(c, valores):
+    """Assign the fields of ``valores`` that actually change ``c``; returns them.
+
+    Unchanged fields are not touched, so an edit that changes nothing
+    leaves ``c`` clean and the caller can skip the commit. The schedule is
+    regenerated only when one of its fields changed.
+    """
+    alteracoes = diferencas_contrato(c, valores)
+    for campo, valor in alteracoes.items():
+        setattr(c, campo, valor)
+    if CAMPOS_CRONOGRAMA & alteracoes.keys():
+        db.session.flush()
+        gerar_parcelas(db.session, Contrato.id == c.id)
+    return alteracoes
+
+def alteracoes_recentes(id, limite=50):
+    return (AuditoriaContrato.query.filter_by(contrato_id=id)
+            .order_by(AuditoriaContrato.id.desc()).limit(limite).all())
 
 @app.route('/info/<int:id>', methods=['GET','POST'])
 def editar_info(id):
+    if request.method == 'GET':
+        validadores = validadores_contrato(id)
+        if validadores is None:
+            abort(404)
+        return resposta_condicional(*validadores, lambda: render_template(
+            'info.html', contrato=db.session.get(Contrato, id), erros={}, alteracoes=alteracoes_recentes(id)))
     c = Contrato.query.get_or_404(id)
-    if request.method == 'POST':
-        c.cooperado = request.form.get('cooperado')
-        c.garantia = request.form.get('garantia')
-        c.valor_contrato_sistema = float(request.form.get('valor_contrato_sistema')) if request.form.get('valor_contrato_sistema') else c.valor_contrato_sistema
-        c.baixa_acima_48_meses = bool(request.form.get('baixa_acima_48_meses'))
-        c.valor_abatido = float(request.form.get('valor_abatido')) if request.form.get('valor_abatido') else c.valor_abatido
-        c.ganho = float(request.form.get('ganho')) if request.form.get('ganho') else c.ganho
-        c.custas = float(request.form.get('custas')) if request.form.get('custas') else c.custas
-        c.custas_deduzidas = float(request.form.get('custas_deduzidas')) if request.form.get('custas_deduzidas') else c.custas_deduzidas
-        c.protesto = float(request.form.get('protesto')) if request.form.get('protesto') else c.protesto
-        c.protesto_deduzido = float(request.form.get('protesto_deduzido')) if request.form.get('protesto_deduzido') else c.protesto_deduzido
-        c.honorario = float(request.form.get('honorario')) if request.form.get('honorario') else c.honorario
-        c.honorario_repassado = float(request.form.get('honorario_repassado')) if request.form.get('honorario_repassado') else c.honorario_repassado
-        c.alvara = float(request.form.get('alvara')) if request.form.get('alvara') else c.alvara
-        c.alvara_recebido = float(request.form.get('alvara_recebido')) if request.form.get('alvara_recebido') else c.alvara_recebido
-        c.valor_entrada = float(request.form.get('valor_entrada')) if request.form.get('valor_entrada') else c.valor_entrada
-        c.vencimento_entrada = datetime.strptime(request.form.get('vencimento_entrada'), '%Y-%m-%d') if request.form.get('vencimento_entrada') else c.vencimento_entrada
-        c.valor_das_parcelas = float(request.form.get('valor_das_parcelas')) if request.form.get('valor_das_parcelas') else c.valor_das_parcelas
-        c.parcelas = int(request.form.get('parcelas')) if request.form.get('parcelas') else c.parcelas
-        c.parcelas_restantes = int(request.form.get('parcelas_restantes')) if request.form.get('parcelas_restantes') else c.parcelas_restantes
-        c.vencimento_parcelas = datetime.strptime(request.form.get('vencimento_parcelas'), '%Y-%m-%d') if request.form.get('vencimento_parcelas') else c.vencimento_parcelas
-        c.quantidade_boletos_emitidos = int(request.form.get('quantidade_boletos_emitidos')) if request.form.get('quantidade_boletos_emitidos') else c.quantidade_boletos_emitidos
-        c.valor_pg_com_boleto = float(request.form.get('valor_pg_com_boleto')) if request.form.get('valor_pg_com_boleto') else c.valor_pg_com_boleto
-        c.data_pg_boleto = datetime.strptime(request.form.get('data_pg_boleto'), '%Y-%m-%d') if request.form.get('data_pg_boleto') else c.data_pg_boleto
-        c.data_baixa = datetime.strptime(request.form.get('data_baixa'), '%Y-%m-%d') if request.form.get('data_baixa') else c.data_baixa
-        c.obs_contabilidade = request.form.get('obs_contabilidade')
-        c.obs_contas_receber = request.form.get('obs_contas_receber')
-        c.valor_repassar_escritorio = float(request.form.get('valor_repassar_escritorio')) if request.form.get('valor_repassar_escritorio') else c.valor_repassar_escritorio
+    dados = request.form.to_dict()
+    # an unchecked checkbox is not submitted at all
+    dados.setdefault('baixa_acima_48_meses', '')
+    valores, erros = ESQUEMA_CONTRATO.coagir(dados, parcial=True, campos=CAMPOS_EDICAO, atual=c)
+    if erros:
+        return render_template('info.html', contrato=c, erros=erros, alteracoes=alteracoes_recentes(id)), 400
+    if atualizar_contrato(c, valores):
         db.session.commit()
-        return redirect(url_for('index'))
-    return render_template('info.html', contrato=c)
+    return redirect(url_for('index'))
 
 @app.route('/parcelas/<int:id>')
 def parcelas(id):
     c = Contrato.query.get_or_404(id)
-    return render_template('parcelas.html', contrato=c)
+    parcelas = Parcela.query.filter_by(contrato_id=id).order_by(Parcela.vencimento, Parcela.numero).all()
+    return render_template('contrato.html', contrato=c, parcelas=parcelas)
+
+@app.route('/parcelas/quitar/<int:id>', methods=['POST'])
+def quitar_parcela(id):
+    p = Parcela.query.get_or_404(id)
+    if not p.quitada:
+        p.quitada = True
+        p.data_pagamento = date.today()
+        c = db.session.get(Contrato, p.contrato_id)
+        # keep the contract in step so a regenerated schedule still marks this one paid
+        c.parcelas_restantes = max((c.parcelas_restantes or 0) - 1, 0)
+        proximo = db.session.execute(
+            db.select(db.func.min(Parcela.vencimento))
+            .where(Parcela.contrato_id == c.id, Parcela.quitada == db.false(), Parcela.id != p.id)).scalar()
+        if proximo is not None:
+            c.vencimento_parcelas = proximo
+        db.session.commit()
+    return redirect(url_for('parcelas', id=p.contrato_id))
+
+COLUNAS_API = ([Contrato.id] + [getattr(Contrato, campo) for campo in ESQUEMA_CONTRATO.conversores]
+               + [Contrato.dias_atraso, Contrato.atualizado_em])
+
+def contrato_api(id):
+    linha = db.session.execute(db.select(*COLUNAS_API).where(Contrato.id == id)).first()
+    return None if linha is None else dict(linha._mapping)
+
+def erro_api(mensagem, status, **extras):
+    return {'erro': mensagem, **extras}, status
+
+@app.route('/api/contratos')
+def api_contratos():
+    """Keyset-paginated contract list; accepts ``q``, ``apos``, ``antes`` and ``por_pagina``."""
+    def listar():
+        consulta = db.session.query(*COLUNAS_API)
+        busca = request.args.get('q', '').strip()
+        if busca:
+            consulta = consulta.filter(*filtros_busca(busca))
+        linhas, anterior, proximo = pagina_keyset(
+            consulta, Contrato.id,
+            apos=request.args.get('apos', type=int),
+            antes=request.args.get('antes', type=int),
+            por_pagina=por_pagina_solicitado())
+        return {'contratos': [dict(linha._mapping) for linha in linhas],
+                'anterior': anterior, 'proximo': proximo}
+    versao, atualizado_em = versao_atual()
+    return resposta_condicional(f'v{versao}', atualizado_em, listar)
+
+@app.route('/api/contratos', methods=['POST'])
+def api_criar_contrato():
+    dados = request.get_json(silent=True)
+    if not isinstance(dados, dict):
+        return erro_api('envie um objeto JSON', 400)
+    valores, erros = ESQUEMA_CONTRATO.coagir(dados)
+    if erros:
+        return erro_api('dados inválidos', 422, campos=erros)
+    c = Contrato(**valores)
+    db.session.add(c)
+    db.session.flush()
+    gerar_parcelas(db.session, Contrato.id == c.id)
+    db.session.commit()
+    return contrato_api(c.id), 201, {'Location': url_for('api_contrato', id=c.id)}
+
+@app.route('/api/contratos/<int:id>')
+def api_contrato(id):
+    validadores = validadores_contrato(id)
+    if validadores is None:
+        return erro_api('contrato não encontrado', 404)
+    return resposta_condicional(*validadores, lambda: contrato_api(id))
+
+@app.route('/api/contratos/<int:id>', methods=['PUT', 'PATCH'])
+def api_atualizar_contrato(id):
+    """PUT replaces every field (missing ones become empty); PATCH changes only those sent."""
+    c = db.session.get(Contrato, id)
+    if c is None:
+        return erro_api('contrato não encontrado', 404)
+    dados = request.get_json(silent=True)
+    if not isinstance(dados, dict):
+        return erro_api('envie um objeto JSON', 400)
+    valores, erros = ESQUEMA_CONTRATO.coagir(dados, parcial=request.method == 'PATCH', atual=c)
+    if erros:
+        return erro_api('dados inválidos', 422, campos=erros)
+    if atualizar_contrato(c, valores):
+        db.session.commit()
+    return contrato_api(id)
+
+COLUNAS_GRADE = {coluna.key: coluna for coluna in COLUNAS_API}
+CONVERSORES_GRADE = {**ESQUEMA_CONTRATO.conversores, 'id': _para_int, 'dias_atraso': _para_int}
+
+def filtros_coluna(nome, valor):
+    """Filters for one grid column search.
+
+    Searchable text columns use the trigram index, other text columns a
+    LIKE scan. Numbers, dates and flags match exactly, or as an inclusive
+    ``de|ate`` range where either end may be left blank.
+    """
+    coluna = COLUNAS_GRADE[nome]
+    if nome in COLUNAS_BUSCA:
+        return filtros_busca(valor, (nome,))
+    if coluna.type.python_type is str:
+        return [coluna.ilike(f'%{valor}%')]
+    if nome not in CONVERSORES_GRADE:
+        raise ValueError('coluna não filtrável')
+    converter = CONVERSORES_GRADE[nome]
+    if '|' not in valor:
+        return [coluna == converter(valor)]
+    de, ate = valor.split('|', 1)
+    filtros = []
+    if not _vazio(de):
+        filtros.append(coluna >= converter(de))
+    if not _vazio(ate):
+        filtros.append(coluna <= converter(ate))
+    return filtros
+
+COLUNAS_AUDITORIA = [AuditoriaContrato.id, AuditoriaContrato.contrato_id, AuditoriaContrato.campo,
+                     AuditoriaContrato.valor_anterior, AuditoriaContrato.valor_novo,
+                     AuditoriaContrato.alterado_em, AuditoriaContrato.usuario]
+
+def pagina_auditoria(*filtros, ordem=None):
+    """One keyset page of audit rows, in the order they were written (or ``ordem``), as an API response."""
+    linhas, anterior, proximo = pagina_keyset(
+        db.session.query(*COLUNAS_AUDITORIA).filter(*filtros), AuditoriaContrato.id,
+        apos=request.args.get('apos', type=int), antes=request.args.get('antes', type=int),
+        por_pagina=por_pagina_solicitado(), ordem=ordem)
+    return {'alteracoes': [dict(linha._mapping) for linha in linhas], 'anterior': anterior, 'proximo': proximo}
+
+@app.route('/api/contratos/<int:id>/auditoria')
+def api_auditoria_contrato(id):
+    """Change history of one contract; accepts ``apos``, ``antes`` and ``por_pagina``."""
+    return pagina_auditoria(AuditoriaContrato.contrato_id == id)
+
+@app.route('/api/auditoria')
+def api_auditoria():
+    """Changes to any contract between the dates ``de`` and ``ate`` (inclusive), paginated like the contracts.
+
+    Rows are filtered and paged on ``(alterado_em, id)``, which the
+    alterado_em index covers: alterado_em is taken before the write lock,
+    so with several workers ids do not follow it.
+    """
+    try:
+        de = date.fromisoformat(request.args['de']) if request.args.get('de') else None
+        ate = date.fromisoformat(request.args['ate']) if request.args.get('ate') else None
+    except ValueError:
+        return erro_api('use datas no formato AAAA-MM-DD', 400)
+    filtros = []
+    if de is not None:
+        filtros.append(AuditoriaContrato.alterado_em >= datetime.combine(de, datetime.min.time()))
+    if ate is not None:
+        filtros.append(AuditoriaContrato.alterado_em < datetime.combine(ate + timedelta(days=1), datetime.min.time()))
+    return pagina_auditoria(*filtros, ordem=[AuditoriaContrato.alterado_em, AuditoriaContrato.id])
+
+@app.route('/api/contratos/grade')
+def api_grade():
+    """Server-side processing for a DataTables grid.
+
+    Reads the DataTables request (``columns[i][data]``, per-column and
+    global ``search[value]``, ``order[j]``, ``start``/``length``) and
+    returns only the requested columns of one page. ``recordsTotal``
+    comes from resumo_carteira; ``recordsFiltered`` is counted only when
+    a filter is active.
+    """
+    args = request.args
+    draw = args.get('draw', 0, type=int)
+    colunas, filtros = [], []
+    try:
+        i = 0
+        while f'columns[{i}][data]' in args:
+            nome = args[f'columns[{i}][data]']
+            if nome not in COLUNAS_GRADE:
+                raise ValueError(f'coluna desconhecida: {nome}')
+            colunas.append(nome)
+            valor = args.get(f'columns[{i}][search][value]', '').strip()
+            if valor and args.get(f'columns[{i}][searchable]', 'true') == 'true':
+                try:
+                    filtros += filtros_coluna(nome, valor)
+                except (TypeError, ValueError) as erro:
+                    raise ValueError(f'{nome}: {erro}') from None
+            i += 1
+        ordem, j = [], 0
+        while f'order[{j}][column]' in args:
+            posicao = args.get(f'order[{j}][column]', type=int)
+            if posicao is None or not 0 <= posicao < len(colunas):
+                raise ValueError('coluna de ordenação inválida')
+            nome = colunas[posicao]
+            ordem.append(COLUNAS_GRADE[nome].desc() if args.get(f'order[{j}][dir]') == 'desc'
+                         else COLUNAS_GRADE[nome].asc())
+            j += 1
+    except ValueError as erro:
+        return {'draw': draw, 'error': str(erro)}, 400
+    busca = args.get('search[value]', '').strip()
+    if busca:
+        filtros += filtros_busca(busca)
+
+    total = db.session.execute(db.select(db.func.coalesce(db.func.sum(ResumoCarteira.contratos), 0))).scalar()
+    filtrados = total
+    if filtros:
+        filtrados = db.session.execute(db.select(db.func.count()).select_from(Contrato).where(*filtros)).scalar()
+    por_pagina = args.get('length', app.config['CONTRATOS_POR_PAGINA'], type=int)
+    if por_pagina < 0 or por_pagina > app.config['CONTRATOS_POR_PAGINA_MAX']:
+        por_pagina = app.config['CONTRATOS_POR_PAGINA_MAX']
+    # page through ids only, which the sort column's index covers, then
+    # fetch the wide rows for that page alone
+    pagina = (db.select(Contrato.id).where(*filtros).order_by(*ordem, Contrato.id)
+              .limit(por_pagina).offset(max(args.get('start', 0, type=int), 0)))
+    consulta = (db.select(Contrato.id, *(COLUNAS_GRADE[nome] for nome in colunas if nome != 'id'))
+                .where(Contrato.id.in_(pagina)).order_by(*ordem, Contrato.id))
+    dados = [dict(linha._mapping) for linha in db.session.execute(consulta)]
+    return {'draw': draw, 'recordsTotal': total, 'recordsFiltered': filtrados, 'data': dados}
+
+@app.route('/grade')
+def grade():
+    return render_template('grade.html')
+
+COLUNAS_POR_ATRIBUTO = {atributo: (rotulo, atributo) for rotulo, atributo in COLUNAS_EXPORTACAO}
+
+def _lista(dados, campo):
+    if hasattr(dados, 'getlist'):
+        return [valor for valor in dados.getlist(campo) if not _vazio(valor)]
+    valor = dados.get(campo)
+    valores = valor if isinstance(valor, list) else [valor]
+    return [valor for valor in valores if not _vazio(valor)]
+
+def selecao_exportacao(dados):
+    """Validate the filter and column parameters of an export into plain JSON values.
+
+    Accepts ``data_contrato_de``/``_ate``, ``data_baixa_de``/``_ate``,
+    ``tipo_contrato`` and ``cooperado`` (repeatable), ``baixa_acima_48_meses``
+    and ``colunas`` (attribute names, repeatable or comma-separated).
+    The result is stored with export jobs and turned into SQL by
+    ``condicoes_exportacao()``.
+    """
+    filtros = {}
+    for campo in ('data_contrato', 'data_baixa'):
+        for limite in ('de', 'ate'):
+            nome = f'{campo}_{limite}'
+            if not _vazio(dados.get(nome)):
+                try:
+                    filtros[nome] = _para_data(dados[nome]).isoformat()
+                except (TypeError, ValueError) as erro:
+                    raise ValueError(f'{nome}: {erro}') from None
+    for campo in ('tipo_contrato', 'cooperado'):
+        valores = _lista(dados, campo)
+        if valores:
+            filtros[campo] = sorted({str(valor).strip() for valor in valores})
+    if not _vazio(dados.get('baixa_acima_48_meses')):
+        filtros['baixa_acima_48_meses'] = _para_bool(dados['baixa_acima_48_meses'])
+    colunas = [nome.strip() for valor in _lista(dados, 'colunas') for nome in str(valor).split(',') if nome.strip()]
+    desconhecidas = [nome for nome in colunas if nome not in COLUNAS_POR_ATRIBUTO]
+    if desconhecidas:
+        raise ValueError(f"colunas desconhecidas: {', '.join(desconhecidas)}")
+    return {'filtros': filtros, 'colunas': list(dict.fromkeys(colunas))}
+
+def colunas_exportacao(selecao):
+    return [COLUNAS_POR_ATRIBUTO[nome] for nome in selecao.get('colunas') or ()] or COLUNAS_EXPORTACAO
+
+def condicoes_exportacao(selecao):
+    """SQL conditions on Contrato for the filters validated by ``selecao_exportacao()``."""
+    filtros = selecao.get('filtros', {})
+    condicoes = []
+    for campo in ('data_contrato', 'data_baixa'):
+        coluna = getattr(Contrato, campo)
+        if f'{campo}_de' in filtros:
+            condicoes.append(coluna >= date.fromisoformat(filtros[f'{campo}_de']))
+        if f'{campo}_ate' in filtros:
+            condicoes.append(coluna <= date.fromisoformat(filtros[f'{campo}_ate']))
+    for campo in ('tipo_contrato', 'cooperado'):
+        if campo in filtros:
+            condicoes.append(getattr(Contrato, campo).in_(filtros[campo]))
+    if 'baixa_acima_48_meses' in filtros:
+        condicoes.append(db.func.coalesce(Contrato.baixa_acima_48_meses, False) == filtros['baixa_acima_48_meses'])
+    return condicoes
+
+def lotes_exportacao(atributos, tamanho_lote, centavos=False, condicoes=()):
+    """Yield the values of ``atributos`` for every contract, one batch of rows at a time.
+
+    Batches are fetched by keyset on ``Contrato.id`` so memory stays bounded
+    by ``tamanho_lote`` no matter how many contracts exist. ``condicoes``
+    are added to the WHERE clause. With ``centavos`` set, money columns
+    come back as raw integer cents.
+    """
+    colunas = [Contrato.id]
+    for atributo in atributos:
+        coluna = getattr(Contrato, atributo)
+        if centavos and isinstance(coluna.type, Centavos):
+            coluna = db.type_coerce(coluna, db.Integer)
+        colunas.append(coluna)
+    conexao = db.session.connection()
+    ultimo = 0
+    while True:
+        linhas = conexao.execute(
+            db.select(*colunas).where(Contrato.id > ultimo, *condicoes).order_by(Contrato.id).limit(tamanho_lote)
+        ).all()
+        if not linhas:
+            return
+        ultimo = linhas[-1][0]
+        yield [linha[1:] for linha in linhas]
+
+def escrever_xlsx(caminho, colunas, condicoes=()):
+    """Write the contracts to ``caminho`` using XlsxWriter's constant-memory mode."""
+    workbook = xlsxwriter.Workbook(caminho, {'constant_memory': True, 'default_date_format': 'dd/mm/yyyy'})
+    planilha = workbook.add_worksheet()
+    planilha.write_row(0, 0, [rotulo for rotulo, _ in colunas])
+    numero_linha = 1
+    for lote in lotes_exportacao([atributo for _, atributo in colunas], app.config['EXPORTACAO_LOTE'],
+                                 condicoes=condicoes):
+        for valores in lote:
+            planilha.write_row(numero_linha, 0, valores)
+            numero_linha += 1
+    workbook.close()
+
+def esquema_arrow(colunas):
+    tipos = {date: pa.date32(), Decimal: pa.decimal128(18, 2), bool: pa.bool_(), int: pa.int64(), str: pa.string()}
+    return pa.schema([(rotulo, tipos[Contrato.__table__.c[atributo].type.python_type]) for rotulo, atributo in colunas])
+
+def _decimal_de_centavos(centavos, tipo):
+    # decimal128 stores the unscaled value as a little-endian 128-bit
+    # integer, so the cents can be laid out directly without Decimal objects
+    inteiros = pa.array(centavos, pa.int64())
+    valores = np.asarray(inteiros.fill_null(0))
+    brutos = np.stack([valores, valores >> 63], axis=1)
+    return pa.Array.from_buffers(tipo, len(inteiros), [inteiros.buffers()[0], pa.py_buffer(brutos.tobytes())],
+                                 null_count=inteiros.null_count)
+
+def lotes_arrow(colunas, esquema, condicoes=()):
+    """Yield the contracts as Arrow record batches, one per ``lotes_exportacao`` batch."""
+    for lote in lotes_exportacao([atributo for _, atributo in colunas], app.config['EXPORTACAO_LOTE'],
+                                 centavos=True, condicoes=condicoes):
+        yield pa.RecordBatch.from_arrays([
+            _decimal_de_centavos(valores, tipo) if pa.types.is_decimal(tipo) else pa.array(valores, tipo)
+            for valores, tipo in zip(zip(*lote), esquema.types)], schema=esquema)
+
+def escrever_parquet(caminho, colunas, condicoes=()):
+    """Write the contracts to a Parquet file, grouping batches into row groups."""
+    esquema = esquema_arrow(colunas)
+    limite = app.config['EXPORTACAO_PARQUET_LINHAS_POR_GRUPO']
+    with pq.ParquetWriter(caminho, esquema, compression='zstd') as escritor:
+        grupo, linhas = [], 0
+        for lote in lotes_arrow(colunas, esquema, condicoes):
+            grupo.append(lote)
+            linhas += lote.num_rows
+            if linhas >= limite:
+                escritor.write_table(pa.Table.from_batches(grupo), row_group_size=linhas)
+                grupo, linhas = [], 0
+        if grupo:
+            escritor.write_table(pa.Table.from_batches(grupo), row_group_size=linhas)
+
+def escrever_arrow(caminho, colunas, condicoes=()):
+    """Write the contracts to an Arrow IPC (Feather v2) file."""
+    esquema = esquema_arrow(colunas)
+    opcoes = pa.ipc.IpcWriteOptions(compression='zstd')
+    with pa.OSFile(caminho, 'wb') as arquivo, pa.ipc.new_file(arquivo, esquema, options=opcoes) as escritor:
+        for lote in lotes_arrow(colunas, esquema, condicoes):
+            escritor.write_batch(lote)
+
+FORMATOS_EXPORTACAO = {'xlsx': ('.xlsx', escrever_xlsx)}
+if pa is not None:
+    FORMATOS_EXPORTACAO.update(parquet=('.parquet', escrever_parquet), arrow=('.arrow', escrever_arrow))
+
+_pool_exportacao = None
+_tarefas_enviadas = set()
+
+def pool_exportacao():
+    """The export process pool of this web worker, created on first use.
+
+    Processes are spawned rather than forked: web workers run threads, and
+    a fresh interpreter opens its own database connections.
+    """
+    global _pool_exportacao
+    if _pool_exportacao is None:
+        _pool_exportacao = ProcessPoolExecutor(
+            max_workers=app.config['EXPORTACAO_PROCESSOS'], mp_context=multiprocessing.get_context('spawn'))
+    return _pool_exportacao
+
+def _exportacao_terminada(tarefa_id, futuro):
+    global _pool_exportacao
+    _tarefas_enviadas.discard(tarefa_id)
+    if not futuro.cancelled() and futuro.exception() is not None:
+        app.logger.error('processo da exportação %s falhou', tarefa_id, exc_info=futuro.exception())
+        if isinstance(futuro.exception(), BrokenProcessPool):
+            # a pool process was killed; the next request gets a fresh pool
+            _pool_exportacao = None
+        with app.app_context():
+            db.session.execute(
+                db.update(TarefaExportacao)
+                .where(TarefaExportacao.id == tarefa_id, TarefaExportacao.status.in_(('pendente', 'executando')))
+                .values(status='erro', erro=str(futuro.exception()), concluida_em=agora_utc()))
+            db.session.commit()
+
+def dono_processo():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def dono_vivo(dono):
+    """Whether the process recorded in ``dono`` still runs; assumed so for other hosts."""
+    if not dono:
+        return True
+    host, _, pid = dono.rpartition(':')
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def executar_exportacao(tarefa_id):
+    """Write the file of one export job; runs in a pool process."""
+    with app.app_context():
+        iniciou = db.session.execute(
+            db.update(TarefaExportacao)
+            .where(TarefaExportacao.id == tarefa_id, TarefaExportacao.status == 'pendente')
+            .values(status='executando', dono=dono_processo(), iniciada_em=agora_utc())).rowcount
+        db.session.commit()
+        if not iniciou:
+            return
+        tarefa = db.session.get(TarefaExportacao, tarefa_id)
+        parametros = json.loads(tarefa.parametros)
+        extensao, escrever = FORMATOS_EXPORTACAO[parametros['formato']]
+        os.makedirs(app.config['EXPORTACAO_DIRETORIO'], exist_ok=True)
+        caminho = os.path.join(app.config['EXPORTACAO_DIRETORIO'], tarefa_id + extensao)
+        try:
+            escrever(caminho + '.parcial', colunas_exportacao(parametros), condicoes_exportacao(parametros))
+            os.replace(caminho + '.parcial', caminho)
+        except Exception as erro:
+            app.logger.exception('exportação %s falhou', tarefa_id)
+            if os.path.exists(caminho + '.parcial'):
+                os.remove(caminho + '.parcial')
+            tarefa.status, tarefa.erro = 'erro', str(erro)
+        else:
+            tarefa.status, tarefa.caminho = 'concluida', caminho
+        tarefa.concluida_em = agora_utc()
+        db.session.commit()
+
+def encerrar_exportacoes():
+    """Stop this web worker's export pool, releasing the jobs it had not started.
+
+    Released jobs are marked as failed so the next identical request
+    submits a new one instead of waiting on them.
+    """
+    global _pool_exportacao
+    if _pool_exportacao is None:
+        return
+    _pool_exportacao.shutdown(wait=False, cancel_futures=True)
+    _pool_exportacao = None
+    with app.app_context():
+        db.session.execute(
+            db.update(TarefaExportacao)
+            .where(TarefaExportacao.id.in_(_tarefas_enviadas), TarefaExportacao.status == 'pendente')
+            .values(status='erro', erro='cancelada no encerramento', concluida_em=agora_utc()))
+        db.session.commit()
+    _tarefas_enviadas.clear()
+
+def limpar_exportacoes():
+    """Expire finished jobs past the retention time and give up on stuck ones."""
+    agora = agora_utc()
+    db.session.execute(
+        db.update(TarefaExportacao)
+        .where(TarefaExportacao.status.in_(('pendente', 'executando')),
+               TarefaExportacao.criada_em < agora - timedelta(minutes=app.config['EXPORTACAO_TEMPO_LIMITE_MINUTOS']))
+        .values(status='erro', erro='tempo limite excedido', concluida_em=agora))
+    vencidas = db.session.execute(
+        db.delete(TarefaExportacao)
+        .where(TarefaExportacao.status.in_(('concluida', 'erro')),
+               TarefaExportacao.concluida_em < agora - timedelta(minutes=app.config['EXPORTACAO_RETENCAO_MINUTOS']))
+        .returning(TarefaExportacao.caminho)).scalars().all()
+    for caminho in vencidas:
+        if caminho and os.path.exists(caminho):
+            os.remove(caminho)
+
+def solicitar_exportacao(parametros):
+    """Return the job producing the export described by ``parametros``, submitting it if needed.
+
+    A job already queued or running for the same parameters is shared, and
+    a finished file is reused as long as no contract has changed since. A
+    shared job whose owning process died (a web worker or pool process
+    killed without ``encerrar_exportacoes``) is failed and submitted again.
+    """
+    limpar_exportacoes()
+    chave = json.dumps(parametros, sort_keys=True)
+    versao = versao_atual().versao
+    pronta = db.session.execute(
+        db.select(TarefaExportacao)
+        .where(TarefaExportacao.chave == chave, TarefaExportacao.versao == versao,
+               TarefaExportacao.status == 'concluida')
+        .order_by(TarefaExportacao.concluida_em.desc()).limit(1)).scalar()
+    if pronta is not None and os.path.exists(pronta.caminho):
+        db.session.commit()
+        return pronta
+    novo_id = uuid.uuid4().hex
+    db.session.execute(sqlite_insert(TarefaExportacao).values(
+        id=novo_id, chave=chave, parametros=chave, versao=versao, status='pendente', dono=dono_processo(),
+        criada_em=agora_utc()
+    ).on_conflict_do_nothing())
+    db.session.commit()
+    tarefa = db.session.execute(
+        db.select(TarefaExportacao)
+        .where(TarefaExportacao.chave == chave, TarefaExportacao.status.in_(('pendente', 'executando')))).scalar()
+    if tarefa is None:
+        # the shared job finished between the insert and this read
+        return solicitar_exportacao(parametros)
+    if tarefa.id != novo_id and tarefa.id not in _tarefas_enviadas and not dono_vivo(tarefa.dono):
+        db.session.execute(
+            db.update(TarefaExportacao)
+            .where(TarefaExportacao.id == tarefa.id, TarefaExportacao.status == tarefa.status,
+                   TarefaExportacao.dono == tarefa.dono)
+            .values(status='erro', erro='processo da exportação encerrado', concluida_em=agora_utc()))
+        db.session.commit()
+        return solicitar_exportacao(parametros)
+    if tarefa.id == novo_id:
+        _tarefas_enviadas.add(novo_id)
+        futuro = pool_exportacao().submit(executar_exportacao, novo_id)
+        futuro.add_done_callback(functools.partial(_exportacao_terminada, novo_id))
+    return tarefa
+
+def tarefa_json(tarefa):
+    dados = {'id': tarefa.id, 'status': tarefa.status, 'parametros': json.loads(tarefa.parametros),
+             'criada_em': tarefa.criada_em, 'concluida_em': tarefa.concluida_em, 'erro': tarefa.erro,
+             'url_status': url_for('exportacao_status', id=tarefa.id)}
+    if tarefa.status == 'concluida':
+        dados['url_arquivo'] = url_for('exportacao_arquivo', id=tarefa.id)
+    return dados
+
+def parametros_exportacao(dados):
+    formato = dados.get('format', 'xlsx')
+    if formato in ('parquet', 'arrow') and pa is None:
+        raise ValueError(f'o formato {formato} requer o pacote pyarrow')
+    if formato not in FORMATOS_EXPORTACAO:
+        raise ValueError(f'formato desconhecido: {formato}')
+    return {'formato': formato, **selecao_exportacao(dados)}
 
 @app.route('/exportar')
 def exportar():
-    contratos = Contrato.query.all()
-    data = [{col: getattr(c, attr) for col, attr in [
-        ('CPF','cpf'),('Cliente','cliente'),('Contrato','numero'),('Tipo','tipo_contrato'),
-        ('Cooperado','cooperado'),('Garantia','garantia'),('Valor Contrato Sistema','valor_contrato_sistema'),
-        ('Baixa >48m','baixa_acima_48_meses'),('Valor Abatido','valor_abatido'),('Ganho','ganho'),
-        ('Custas','custas'),('Custas Deduzidas','custas_deduzidas'),('Protesto','protesto'),
-        ('Protesto Deduzido','protesto_deduzido'),('Honorario','honorario'),
-        ('Honorario Repassado','honorario_repassado'),('Alvará','alvara'),
-        ('Alvará Recebido','alvara_recebido'),('Valor Entrada','valor_entrada'),
-        ('Vencimento Entrada','vencimento_entrada'),('Valor Parcelas','valor_das_parcelas'),
-        ('Parcelas','parcelas'),('Parcelas Restantes','parcelas_restantes'),
-        ('Vencimento Parcelas','vencimento_parcelas'),
-        ('Quantidade Boletos','quantidade_boletos_emitidos'),
-        ('Valor Pg Boleto','valor_pg_com_boleto'),
-        ('Data Pg Boleto','data_pg_boleto'),('Data Baixa','data_baixa'),
-        ('Obs Contabilidade','obs_contabilidade'),('Obs Contas Receber','obs_contas_receber'),
-        ('Valor Repassar Escritório','valor_repassar_escritorio')
-    ]} for c in contratos]
-    df = pd.DataFrame(data)
-    buf = BytesIO()
-    with pd.ExcelWriter(buf, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False)
-    buf.seek(0)
-    return send_file(buf, download_name='contratos.xlsx', as_attachment=True)
+    """Submit (or join) an export job and show a page that waits for it."""
+    try:
+        parametros = parametros_exportacao(request.args)
+    except ValueError as erro:
+        abort(400, str(erro))
+    tarefa = solicitar_exportacao(parametros)
+    return render_template('exportacao.html', tarefa=tarefa_json(tarefa)), 202
+
+SEPARADORES_CSV = {';': ';', ',': ',', 'tab': '\t'}
+
+def linhas_csv(colunas, separador, decimal, condicoes=()):
+    """Yield the contracts as CSV text, one chunk per ``lotes_exportacao`` batch.
+
+    Money is read as raw cents and written with ``decimal`` as the decimal
+    mark; dates are ISO. The header goes out before the first query runs.
+    """
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer, delimiter=separador, lineterminator='\r\n')
+    escritor.writerow([rotulo for rotulo, _ in colunas])
+    yield buffer.getvalue()
+    monetarias = [i for i, (_, atributo) in enumerate(colunas) if isinstance(getattr(Contrato, atributo).type, Centavos)]
+    for lote in lotes_exportacao([atributo for _, atributo in colunas], app.config['EXPORTACAO_LOTE'],
+                                 centavos=True, condicoes=condicoes):
+        buffer.seek(0)
+        buffer.truncate()
+        for valores in lote:
+            if monetarias:
+                valores = list(valores)
+                for i in monetarias:
+                    centavos = valores[i]
+                    if centavos is not None:
+                        valores[i] = f"{'-' if centavos < 0 else ''}{abs(centavos) // 100}{decimal}{abs(centavos) % 100:02d}"
+            escritor.writerow(valores)
+        yield buffer.getvalue()
+
+@app.route('/exportar.csv')
+def exportar_csv():
+    """Stream the contracts as CSV; ``separador`` is ``;`` (default), ``,`` or ``tab``, ``decimal`` ``,`` or ``.``.
+
+    Takes the same filter and column parameters as the other exports.
+    """
+    separador = SEPARADORES_CSV.get(request.args.get('separador', ';'))
+    decimal = request.args.get('decimal', ',')
+    if separador is None or decimal not in (',', '.') or decimal == separador:
+        abort(400, 'use separador ; , ou tab e decimal , ou . (diferentes entre si)')
+    try:
+        selecao = selecao_exportacao(request.args)
+    except ValueError as erro:
+        abort(400, str(erro))
+    resposta = app.response_class(stream_with_context(linhas_csv(
+        colunas_exportacao(selecao), separador, decimal, condicoes_exportacao(selecao))), mimetype='text/csv')
+    resposta.headers['Content-Disposition'] = 'attachment; filename=contratos.csv'
+    return resposta
+
+@app.route('/exportacoes', methods=['POST'])
+def exportacao_criar():
+    try:
+        parametros = parametros_exportacao(request.get_json(silent=True) or request.values)
+    except ValueError as erro:
+        return erro_api(str(erro), 400)
+    tarefa = solicitar_exportacao(parametros)
+    return tarefa_json(tarefa), 202, {'Location': url_for('exportacao_status', id=tarefa.id)}
+
+@app.route('/exportacoes/<id>')
+def exportacao_status(id):
+    tarefa = db.session.get(TarefaExportacao, id)
+    if tarefa is None:
+        return erro_api('exportação não encontrada', 404)
+    return tarefa_json(tarefa)
+
+@app.route('/exportacoes/<id>/arquivo')
+def exportacao_arquivo(id):
+    tarefa = db.session.get(TarefaExportacao, id)
+    if tarefa is None or tarefa.status != 'concluida' or not os.path.exists(tarefa.caminho):
+        return erro_api('arquivo não disponível', 404)
+    formato = json.loads(tarefa.parametros)['formato']
+    return send_file(tarefa.caminho, download_name=f'contratos.{formato}', as_attachment=True)
+
+@app.route('/boletos/remessa', methods=['GET', 'POST'])
+def remessa():
+    """Generate a CNAB remittance for a due-date range and list the recent ones."""
+    erro = None
+    if request.method == 'POST':
+        try:
+            inicio = date.fromisoformat(request.form['de'])
+            fim = date.fromisoformat(request.form['ate'])
+            gerar_remessa(db.session, inicio, fim, request.form.get('layout'))
+            db.session.commit()
+            return redirect(url_for('remessa'))
+        except (KeyError, ValueError) as e:
+            db.session.rollback()
+            erro = f'Parâmetros inválidos: {e}'
+        except BaseException:
+            db.session.rollback()
+            raise
+    remessas = Remessa.query.order_by(Remessa.id.desc()).limit(20).all()
+    return render_template('remessas.html', remessas=remessas, erro=erro, layout=app.config['CNAB_LAYOUT'])
+
+@app.route('/boletos/retorno', methods=['GET', 'POST'])
+def retorno():
+    """Upload a CNAB return file and settle the boletos it reports as paid."""
+    relatorio = erro = None
+    if request.method == 'POST':
+        arquivo = request.files.get('arquivo')
+        if not arquivo or not arquivo.filename:
+            erro = 'Selecione o arquivo de retorno.'
+        else:
+            try:
+                relatorio = processar_retorno(db.session.connection(),
+                                              io.TextIOWrapper(arquivo.stream, encoding='latin-1', newline=''),
+                                              app.config['CNAB_LOTE'])
+                db.session.commit()
+            except ValueError as e:
+                db.session.rollback()
+                erro = str(e)
+            except BaseException:
+                db.session.rollback()
+                raise
+    return render_template('retorno.html', relatorio=relatorio, erro=erro), (400 if erro else 200)
+
+@app.route('/conciliacao', methods=['GET', 'POST'])
+def conciliacao_extratos():
+    """Upload a bank statement for reconciliation and list the recent ones."""
+    erro = None
+    if request.method == 'POST':
+        arquivo = request.files.get('arquivo')
+        if not arquivo or not arquivo.filename:
+            erro = 'Selecione um extrato .ofx ou .csv.'
+        else:
+            try:
+                extrato = importar_extrato(
+                    db.session, io.TextIOWrapper(arquivo.stream, encoding='utf-8-sig', errors='replace', newline=''),
+                    arquivo.filename)
+                db.session.commit()
+                return redirect(url_for('conciliacao_extrato', id=extrato.id))
+            except ValueError as e:
+                db.session.rollback()
+                erro = str(e)
+            except BaseException:
+                db.session.rollback()
+                raise
+    extratos = Extrato.query.order_by(Extrato.id.desc()).limit(20).all()
+    return render_template('conciliacao.html', extratos=extratos, erro=erro), (400 if erro else 200)
+
+@app.route('/conciliacao/<int:id>')
+def conciliacao_extrato(id):
+    """The proposed matches of a statement, for review, and the credits left without one."""
+    extrato = db.get_or_404(Extrato, id)
+    lancamentos = {
+        status: db.session.execute(
+            db.select(LancamentoExtrato, Contrato.cliente, Contrato.numero)
+            .outerjoin(Contrato, Contrato.id == LancamentoExtrato.contrato_id)
+            .where(LancamentoExtrato.extrato_id == id, LancamentoExtrato.status == status)
+            .order_by(LancamentoExtrato.linha).limit(500)).all()
+        for status in ('proposto', 'sem_par')}
+    return render_template('conciliacao_extrato.html', extrato=extrato, lancamentos=lancamentos)
+
+@app.route('/conciliacao/<int:id>/confirmar', methods=['POST'])
+def conciliacao_confirmar(id):
+    extrato = db.get_or_404(Extrato, id)
+    ids = None if request.form.get('todos') else [int(i) for i in request.form.getlist('ids') if i.isdigit()]
+    try:
+        confirmar_extrato(db.session, extrato, ids)
+        db.session.commit()
+    except BaseException:
+        db.session.rollback()
+        raise
+    return redirect(url_for('conciliacao_extrato', id=id))
+
+@app.route('/boletos/remessas/<int:id>/arquivo')
+def remessa_arquivo(id):
+    r = db.get_or_404(Remessa, id)
+    if not r.caminho or not os.path.exists(r.caminho):
+        abort(404)
+    return send_file(r.caminho, download_name=os.path.basename(r.caminho), as_attachment=True,
+                     mimetype='text/plain')
+
+ATRIBUTOS_IMPORTACAO = dict(COLUNAS_EXPORTACAO)
+ATRIBUTOS_IMPORTACAO.update({atributo: atributo for _, atributo in COLUNAS_EXPORTACAO})
+def linhas_planilha(arquivo, nome):
+    """Yield the rows of a CSV or XLSX upload as lists, header first, without loading it whole.
+
+    A file that cannot be parsed raises ``ValueError``.
+    """
+    extensao = os.path.splitext(nome)[1].lower()
+    if extensao == '.xlsx':
+        try:
+            workbook = openpyxl.load_workbook(arquivo, read_only=True, data_only=True)
+        except (zipfile.BadZipFile, KeyError, InvalidFileException):
+            raise ValueError(f'{nome} não é uma planilha .xlsx válida.') from None
+        try:
+            yield from workbook.active.iter_rows(values_only=True)
+        finally:
+            workbook.close()
+    elif extensao == '.csv':
+        texto = io.TextIOWrapper(arquivo, encoding='utf-8-sig', newline='')
+        amostra = texto.read(4096)
+        texto.seek(0)
+        try:
+            formato = {'dialect': csv.Sniffer().sniff(amostra, delimiters=',;\t')}
+        except csv.Error:
+            # a single column (or an empty file) has no delimiter to detect
+            formato = {'delimiter': ';'}
+        try:
+            yield from csv.reader(texto, **formato)
+        except csv.Error as erro:
+            raise ValueError(f'{nome} não é um CSV válido: {erro}') from None
+    else:
+        raise ValueError(f'Formato não suportado: {nome} (use .csv ou .xlsx)')
+
+def importar_contratos(arquivo, nome):
+    """Insert every row of a CSV/XLSX file as a Contrato, in batches.
+
+    Headers may be the labels written by ``exportar()`` or the attribute
+    names. Rows are inserted ``IMPORTACAO_LOTE`` at a time with a single
+    executemany, committing every ``IMPORTACAO_COMMIT_A_CADA`` batches.
+    Each batch's installment schedules are generated with it, so whatever
+    is committed is complete. A row that cannot be converted aborts the
+    import with ``ValueError``; batches committed before it are kept.
+    Returns ``(linhas, segundos)``.
+    """
+    inicio = time.perf_counter()
+
+    def inserir(lote):
+        ids = db.session.execute(db.insert(Contrato).returning(Contrato.id, sort_by_parameter_order=True),
+                                 lote).scalars().all()
+        gerar_parcelas(db.session, Contrato.id.between(ids[0], ids[-1]))
+        return len(ids)
+
+    linhas = linhas_planilha(arquivo, nome)
+    cabecalho = next(linhas, None)
+    if cabecalho is None:
+        raise ValueError('Arquivo vazio.')
+    mapeamento = [(indice, ATRIBUTOS_IMPORTACAO[str(rotulo).strip()])
+                  for indice, rotulo in enumerate(cabecalho)
+                  if rotulo is not None and str(rotulo).strip() in ATRIBUTOS_IMPORTACAO]
+    if not mapeamento:
+        raise ValueError('Nenhuma coluna reconhecida no cabeçalho.')
+    tamanho_lote = app.config['IMPORTACAO_LOTE']
+    commit_a_cada = app.config['IMPORTACAO_COMMIT_A_CADA']
+    lote, lotes, total = [], 0, 0
+    for numero_linha, linha in enumerate(linhas, start=2):
+        if not any(valor not in (None, '') for valor in linha):
+            continue
+        valores, erros = ESQUEMA_CONTRATO.coagir(
+            {atributo: linha[indice] for indice, atributo in mapeamento if indice < len(linha)})
+        if erros:
+            db.session.rollback()
+            raise ValueError(f'Linha {numero_linha}: ' + '; '.join(f'{campo}: {erro}' for campo, erro in erros.items()))
+        lote.append(valores)
+        if len(lote) == tamanho_lote:
+            total += inserir(lote)
+            lote = []
+            lotes += 1
+            if lotes % commit_a_cada == 0:
+                db.session.commit()
+    if lote:
+        total += inserir(lote)
+    db.session.commit()
+    return total, time.perf_counter() - inicio
+
+@app.route('/importar', methods=['GET', 'POST'])
+def importar():
+    resultado = erro = None
+    if request.method == 'POST':
+        arquivo = request.files.get('arquivo')
+        if not arquivo or not arquivo.filename:
+            erro = 'Selecione um arquivo .csv ou .xlsx.'
+        else:
+            try:
+                linhas, segundos = importar_contratos(arquivo.stream, arquivo.filename)
+                resultado = {'linhas': linhas, 'segundos': segundos,
+                             'linhas_por_segundo': linhas / segundos if segundos else linhas}
+            except ValueError as e:
+                erro = str(e)
+    return render_template('importar.html', resultado=resultado, erro=erro), (400 if erro else 200)
+
+@app.cli.command('import-contratos')
+@click.argument('caminho', type=click.Path(exists=True, dir_okay=False))
+def import_contratos(caminho):
+    """Import contracts from a CSV or XLSX file."""
+    with open(caminho, 'rb') as arquivo:
+        try:
+            linhas, segundos = importar_contratos(arquivo, caminho)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    click.echo(f'{linhas} contratos importados em {segundos:.2f}s '
+               f'({linhas / segundos if segundos else linhas:.0f} linhas/s)')
+
+def create_app():
+    """Return the application ready to serve, for WSGI servers and ``python3 app.py``.
+
+    Runs pending migrations once, unless ``MIGRAR_NA_INICIALIZACAO`` is
+    off. Under gunicorn with ``preload_app`` this happens in the master,
+    before any worker is forked. The application and its database are
+    configured at import, from ``DATABASE_URL`` and ``FLASK_*`` environment
+    variables only; spawned export processes import it the same way, so
+    set the environment rather than changing ``app.config`` afterwards.
+    """
+    if app.config['MIGRAR_NA_INICIALIZACAO']:
+        with app.app_context():
+            aplicar_migracoes()
+    return app
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port, debug=True)
+    create_app().run(host='0.0.0.0', port=port, debug=os.environ.get('FLASK_DEBUG') == '1')
@@ -0,0 +1,62 @@
+"""Write time, file size and pandas read time of each export format.
+
+Seeds a throwaway SQLite file and runs every writer registered in
+``FORMATOS_EXPORTACAO`` over the full column set, then loads each file
+with pandas (``read_excel``, ``read_parquet``, ``read_feather``) when it
+is installed::
+
+    python benchmarks/bench_exportacao.py --contratos 100000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--contratos', type=int, default=100000)
+    args = parser.parse_args()
+
+    diretorio = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(diretorio, 'bench.db')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from app import create_app, db, Contrato, COLUNAS_EXPORTACAO, FORMATOS_EXPORTACAO
+    app = create_app()
+    try:
+        import pandas as pd
+    except ImportError:
+        pd = None
+    leitores = {'xlsx': 'read_excel', 'parquet': 'read_parquet', 'arrow': 'read_feather'}
+
+    aleatorio = random.Random(1)
+    inicio = date(2020, 1, 1)
+    with app.app_context():
+        for base in range(0, args.contratos, 20000):
+            db.session.execute(db.insert(Contrato), [{
+                'cpf': f'{i:011d}', 'cliente': f'Cliente {i}', 'numero': f'C-{i}', 'tipo_contrato': 'Pessoal',
+                'cooperado': f'Cooperado {i % 40}', 'data_contrato': inicio + timedelta(days=i % 1500),
+                'valor_contrato_sistema': aleatorio.randrange(10 ** 7) / 100, 'valor_abatido': aleatorio.randrange(10 ** 6) / 100,
+                'parcelas': 12, 'parcelas_restantes': i % 13, 'vencimento_parcelas': inicio + timedelta(days=i % 900),
+                'obs_contabilidade': 'sem observações',
+            } for i in range(base, min(base + 20000, args.contratos))])
+            db.session.commit()
+
+        print(f'{args.contratos} contratos, {len(COLUNAS_EXPORTACAO)} colunas')
+        for formato, (extensao, escrever) in FORMATOS_EXPORTACAO.items():
+            caminho = os.path.join(diretorio, 'contratos' + extensao)
+            comeco = time.perf_counter()
+            escrever(caminho, COLUNAS_EXPORTACAO)
+            escrita = time.perf_counter() - comeco
+            leitura = ''
+            if pd is not None:
+                comeco = time.perf_counter()
+                getattr(pd, leitores[formato])(caminho)
+                leitura = f'leitura {time.perf_counter() - comeco:7.2f}s'
+            tamanho = os.path.getsize(caminho) / 2 ** 20
+            print(f'  {formato:<8} escrita {escrita:7.2f}s  {tamanho:7.1f} MiB  {leitura}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Encoding time of one API page with each JSON backend of ``ProvedorJSON``.
+
+Builds a page of contracts shaped like the ``/api/contratos`` response
+(``Decimal`` money, ``date`` fields, text) and compares Flask's stock
+provider (stdlib ``json.dumps`` with its ``default`` hook) against
+``ProvedorJSON`` on orjson, msgspec and the stdlib fallback, skipping
+libraries that are not installed::
+
+    python benchmarks/bench_json.py --linhas 10000 --repeticoes 20
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+
+def pagina(linhas):
+    inicio = date(2024, 1, 1)
+    contratos = []
+    for i in range(linhas):
+        contratos.append({
+            'id': i + 1, 'cpf': f'{i:011d}', 'cliente': f'Cliente {i} da Silva', 'numero': f'C-{i}',
+            'tipo_contrato': 'Pessoal', 'cooperado': f'Cooperado {i % 50}', 'garantia': None,
+            'valor_contrato_sistema': Decimal(i * 37 % 1000000).scaleb(-2), 'baixa_acima_48_meses': i % 7 == 0,
+            'valor_abatido': Decimal(i * 13 % 500000).scaleb(-2), 'ganho': Decimal(i % 9999).scaleb(-2),
+            'custas': None, 'honorario': Decimal(i % 4321).scaleb(-2), 'valor_das_parcelas': Decimal('150.75'),
+            'parcelas': 12, 'parcelas_restantes': i % 12, 'vencimento_entrada': inicio + timedelta(days=i % 365),
+            'vencimento_parcelas': inicio + timedelta(days=i % 700), 'data_baixa': None,
+            'obs_contabilidade': 'ação de cobrança', 'dias_atraso': i % 120,
+        })
+    return {'contratos': contratos, 'anterior': None, 'proximo': linhas}
+
+def medir(codificar, repeticoes):
+    codificar()
+    tempos = []
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        tamanho = len(codificar())
+        tempos.append((time.perf_counter() - inicio) * 1000)
+    tempos.sort()
+    return tempos[len(tempos) // 2], tamanho
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--linhas', type=int, default=10000)
+    parser.add_argument('--repeticoes', type=int, default=20)
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from flask.json.provider import DefaultJSONProvider
+    import app as modulo
+    app = modulo.create_app()
+    dados = pagina(args.linhas)
+
+    padrao = DefaultJSONProvider(app)
+    backends = [('Flask padrão (json + default)', lambda: padrao.dumps(dados, separators=(',', ':')).encode())]
+    instalados = {'orjson': modulo.orjson, 'msgspec': modulo.msgspec}
+
+    def com_backend(nome):
+        # ProvedorJSON picks its backend from the module globals at call time
+        def codificar():
+            modulo.orjson = instalados['orjson'] if nome == 'orjson' else None
+            modulo.msgspec = instalados['msgspec'] if nome == 'msgspec' else None
+            return provedor.codificar(dados)
+        modulo.msgspec = instalados['msgspec'] if nome == 'msgspec' else None
+        provedor = modulo.ProvedorJSON(app)
+        return codificar
+
+    for nome in ('orjson', 'msgspec', 'stdlib'):
+        if nome in instalados and instalados[nome] is None:
+            print(f'  ProvedorJSON {nome:<19} não instalado')
+            continue
+        backends.append((f'ProvedorJSON {nome}', com_backend(nome)))
+
+    print(f'{args.linhas} contratos por página, mediana de {args.repeticoes} codificações')
+    base = None
+    for nome, codificar in backends:
+        ms, tamanho = medir(codificar, args.repeticoes)
+        base = base or ms
+        print(f'  {nome:<32} {ms:8.2f} ms  {tamanho / 1024:8.0f} KiB  {base / ms:5.1f}x')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Per-request latency of ``/`` and ``/info/<id>`` with and without DDL checks.
+
+Compares the old behaviour, where a ``before_request`` hook called
+``db.create_all()`` on every request, against the current one where the
+schema is migrated once at startup. Runs against a throwaway SQLite file::
+
+    python benchmarks/bench_requisicao.py --contratos 20000 --requisicoes 500
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+def medir(cliente, url, requisicoes):
+    tempos = []
+    for _ in range(requisicoes):
+        inicio = time.perf_counter()
+        resposta = cliente.get(url)
+        tempos.append((time.perf_counter() - inicio) * 1000)
+        assert resposta.status_code == 200, resposta.status_code
+    tempos.sort()
+    return statistics.mean(tempos), tempos[len(tempos) // 2], tempos[int(len(tempos) * 0.95)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--contratos', type=int, default=20000)
+    parser.add_argument('--requisicoes', type=int, default=500)
+    args = parser.parse_args()
+
+    diretorio = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(diretorio, 'bench.db')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from app import create_app, db, Contrato
+    app = create_app()
+
+    with app.app_context():
+        db.session.execute(db.insert(Contrato), [
+            {'cpf': f'{i:011d}', 'cliente': f'Cliente {i}', 'numero': f'C-{i}', 'tipo_contrato': 'Pessoal'}
+            for i in range(args.contratos)
+        ])
+        db.session.commit()
+    cliente = app.test_client()
+    urls = ['/', f'/info/{args.contratos // 2}']
+
+    def create_all_por_requisicao():
+        db.create_all()
+
+    print(f'{args.contratos} contratos, {args.requisicoes} requisições por rota (ms: média / p50 / p95)')
+    for modo in ('create_all por requisição', 'migração na inicialização'):
+        if modo.startswith('create_all'):
+            app.before_request_funcs.setdefault(None, []).append(create_all_por_requisicao)
+        else:
+            app.before_request_funcs[None].remove(create_all_por_requisicao)
+        for url in urls:
+            medir(cliente, url, 20)
+            media, p50, p95 = medir(cliente, url, args.requisicoes)
+            print(f'  {modo:<28} {url:<14} {media:7.2f} {p50:7.2f} {p95:7.2f}')
+
+if __name__ == '__main__':
+    main()
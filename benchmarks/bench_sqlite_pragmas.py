@@ -0,0 +1,104 @@
+"""Mixed read/write throughput with SQLite's defaults versus ``SQLITE_PRAGMAS``.
+
+Reader threads scan the whole contrato table in keyset batches inside one
+transaction, as an export does, while writer threads update single rows
+and commit. Each profile runs on its own copy of the same seeded file,
+because ``journal_mode`` is persistent::
+
+    python benchmarks/bench_sqlite_pragmas.py --contratos 100000 --segundos 10
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+PADRAO_SQLITE = {'journal_mode': 'DELETE', 'synchronous': 'FULL'}
+
+def executar(engine, leitores, escritores, segundos, contratos):
+    from sqlalchemy import exc, text
+    fim = time.monotonic() + segundos
+    contagem = {'linhas_lidas': 0, 'escritas': 0, 'bloqueios': 0}
+    trava = threading.Lock()
+
+    def somar(chave, valor=1):
+        with trava:
+            contagem[chave] += valor
+
+    def ler():
+        while time.monotonic() < fim:
+            with engine.connect() as conexao, conexao.begin():
+                ultimo = 0
+                while time.monotonic() < fim:
+                    linhas = conexao.execute(text(
+                        'SELECT id, cpf, cliente, valor_abatido FROM contrato WHERE id > :ultimo ORDER BY id LIMIT 5000'
+                    ), {'ultimo': ultimo}).all()
+                    if not linhas:
+                        break
+                    ultimo = linhas[-1][0]
+                    somar('linhas_lidas', len(linhas))
+
+    def escrever(semente):
+        contrato_id = semente
+        while time.monotonic() < fim:
+            contrato_id = contrato_id * 7919 % contratos + 1
+            try:
+                with engine.begin() as conexao:
+                    conexao.execute(text('UPDATE contrato SET ganho = COALESCE(ganho, 0) + 1 WHERE id = :id'),
+                                    {'id': contrato_id})
+                somar('escritas')
+            except exc.OperationalError:
+                somar('bloqueios')
+
+    threads = [threading.Thread(target=ler) for _ in range(leitores)]
+    threads += [threading.Thread(target=escrever, args=(i + 1,)) for i in range(escritores)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return contagem
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--contratos', type=int, default=100000)
+    parser.add_argument('--segundos', type=float, default=10)
+    parser.add_argument('--leitores', type=int, default=2)
+    parser.add_argument('--escritores', type=int, default=4)
+    args = parser.parse_args()
+
+    diretorio = tempfile.mkdtemp()
+    base = os.path.join(diretorio, 'base.db')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + base
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from app import create_app, db, Contrato
+    app = create_app()
+    from sqlalchemy import create_engine
+
+    perfil = app.config['SQLITE_PRAGMAS']
+    app.config['SQLITE_PRAGMAS'] = PADRAO_SQLITE
+    with app.app_context():
+        db.engine.dispose()
+        db.session.execute(db.insert(Contrato), [
+            {'cpf': f'{i:011d}', 'cliente': f'Cliente {i}', 'numero': f'C-{i}', 'valor_abatido': i / 100}
+            for i in range(args.contratos)
+        ])
+        db.session.commit()
+        db.session.remove()
+        db.engine.dispose()
+
+    print(f'{args.contratos} contratos, {args.leitores} leitores, {args.escritores} escritores, {args.segundos:.0f}s')
+    for nome, pragmas in (('padrão do SQLite', PADRAO_SQLITE), ('SQLITE_PRAGMAS', perfil)):
+        arquivo = os.path.join(diretorio, f'{len(nome)}.db')
+        shutil.copy(base, arquivo)
+        app.config['SQLITE_PRAGMAS'] = pragmas
+        engine = create_engine('sqlite:///' + arquivo)
+        contagem = executar(engine, args.leitores, args.escritores, args.segundos, args.contratos)
+        engine.dispose()
+        print(f'  {nome:<18} escritas/s {contagem["escritas"] / args.segundos:9.0f}   '
+              f'linhas lidas/s {contagem["linhas_lidas"] / args.segundos:11.0f}   '
+              f'"database is locked" {contagem["bloqueios"]}')
+
+if __name__ == '__main__':
+    main()
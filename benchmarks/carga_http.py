@@ -0,0 +1,75 @@
+"""HTTP load test for ``/`` and ``/info/<id>`` against a running server.
+
+Compare the old debug server with the gunicorn setup on the same
+database, for example::
+
+    # before: single-process Werkzeug server
+    FLASK_DEBUG=1 python3 app.py
+    python benchmarks/carga_http.py http://127.0.0.1:5000 --id 1
+
+    # after: preloaded gunicorn workers
+    gunicorn -c gunicorn.conf.py wsgi:app
+    python benchmarks/carga_http.py http://127.0.0.1:5000 --id 1
+
+Each client thread keeps one HTTP/1.1 connection open and issues requests
+back to back for ``--segundos``; the script prints requests/s and latency
+percentiles per route.
+"""
+import argparse
+import http.client
+import threading
+import time
+from urllib.parse import urlsplit
+
+def carregar(url_base, caminho, clientes, segundos):
+    partes = urlsplit(url_base)
+    fim = time.monotonic() + segundos
+    tempos, erros = [], [0]
+    trava = threading.Lock()
+
+    def cliente():
+        conexao = http.client.HTTPConnection(partes.hostname, partes.port or 80, timeout=30)
+        locais = []
+        while time.monotonic() < fim:
+            inicio = time.perf_counter()
+            try:
+                conexao.request('GET', caminho)
+                resposta = conexao.getresponse()
+                resposta.read()
+                if resposta.status != 200:
+                    raise http.client.HTTPException(resposta.status)
+                locais.append(time.perf_counter() - inicio)
+            except (OSError, http.client.HTTPException):
+                with trava:
+                    erros[0] += 1
+                conexao.close()
+                conexao = http.client.HTTPConnection(partes.hostname, partes.port or 80, timeout=30)
+        conexao.close()
+        with trava:
+            tempos.extend(locais)
+
+    threads = [threading.Thread(target=cliente) for _ in range(clientes)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    tempos.sort()
+    if not tempos:
+        return 0, 0, 0, erros[0]
+    return (len(tempos) / segundos, tempos[len(tempos) // 2] * 1000,
+            tempos[int(len(tempos) * 0.95)] * 1000, erros[0])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('url_base')
+    parser.add_argument('--id', type=int, default=1, help='contrato usado em /info/<id>')
+    parser.add_argument('--clientes', type=int, default=16)
+    parser.add_argument('--segundos', type=float, default=15)
+    args = parser.parse_args()
+    print(f'{args.clientes} clientes, {args.segundos:.0f}s por rota')
+    for caminho in ('/', f'/info/{args.id}'):
+        por_segundo, p50, p95, erros = carregar(args.url_base, caminho, args.clientes, args.segundos)
+        print(f'  {caminho:<12} {por_segundo:8.1f} req/s   p50 {p50:7.1f} ms   p95 {p95:7.1f} ms   erros {erros}')
+
+if __name__ == '__main__':
+    main()
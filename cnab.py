@@ -0,0 +1,280 @@
+"""CNAB 240 and 400 boleto remittance (remessa) and return (retorno) records.
+
+Pure formatting, no database access: ``remessa()`` turns the beneficiary
+settings and an iterable of titles into the lines of a remittance file,
+and ``retorno()`` reads the occurrences back from a return file.
+Field positions follow the FEBRABAN CNAB 240 layout (header, batch
+header, segments P and Q, trailers) and the common CNAB 400 layout;
+banks differ in a few fields, so values that vary per agreement come
+from the ``cedente`` settings.
+
+Each layout is compiled once per file: constant fields are rendered up
+front and only the per-title fields are formatted for every record.
+"""
+from datetime import datetime
+import functools
+import operator
+import unicodedata
+
+PESOS_MODULO11 = [2 + i % 8 for i in range(40)]
+
+def modulo11(numero):
+    """Check digit of ``numero`` by modulo 11 with weights 2 to 9."""
+    soma = sum(map(operator.mul, map(int, reversed(str(numero))), PESOS_MODULO11))
+    digito = 11 - soma % 11
+    return 0 if digito >= 10 else digito
+
+def _alfa(valor, tamanho):
+    texto = str(valor or '')
+    if not texto.isascii():
+        texto = unicodedata.normalize('NFKD', texto).encode('ascii', 'ignore').decode('ascii')
+    return texto.upper()[:tamanho].ljust(tamanho)
+
+def _numero(valor, tamanho):
+    texto = str(valor if type(valor) is int else int(valor or 0))
+    if len(texto) > tamanho:
+        raise ValueError(f'{valor} não cabe em {tamanho} dígitos')
+    return texto.rjust(tamanho, '0')
+
+@functools.lru_cache(maxsize=4096)
+def _data8(valor, tamanho):
+    return valor.strftime('%d%m%Y') if valor else '0' * tamanho
+
+@functools.lru_cache(maxsize=4096)
+def _data6(valor, tamanho):
+    return valor.strftime('%d%m%y') if valor else '0' * tamanho
+
+FORMATOS = {'A': _alfa, 'N': _numero, 'D8': _data8, 'D6': _data6}
+
+class Registro:
+    """A fixed-width record: ``campos`` is a list of ``(nome, tamanho, tipo, padrao)``.
+
+    ``tipo`` is ``A`` (text, left-aligned), ``N`` (number, zero-filled),
+    ``D8`` (DDMMAAAA) or ``D6`` (DDMMAA). Fields without a value take
+    ``padrao``.
+    """
+
+    def __init__(self, largura, campos):
+        if sum(campo[1] for campo in campos) != largura:
+            raise ValueError(f'layout com {sum(campo[1] for campo in campos)} posições, esperado {largura}')
+        self.campos = campos
+
+    def compilar(self, variaveis=(), **fixos):
+        """Return a function of the ``variaveis`` fields that renders the record.
+
+        Every other field takes its value from ``fixos`` or its default and
+        is rendered once here, so only the fields that change from record
+        to record are formatted per call.
+        """
+        modelo, campos_variaveis = [], []
+        for nome, tamanho, tipo, padrao in self.campos:
+            if nome not in variaveis:
+                texto = FORMATOS[tipo](fixos.get(nome, padrao) if nome else padrao, tamanho)
+                if modelo and modelo[-1] is not None:
+                    modelo[-1] += texto
+                else:
+                    modelo.append(texto)
+            else:
+                campos_variaveis.append((len(modelo), nome, tamanho, FORMATOS[tipo], padrao))
+                modelo.append(None)
+        modelo.append('\r\n')
+
+        def renderizar(**valores):
+            partes = modelo.copy()
+            for posicao, nome, tamanho, formatar, padrao in campos_variaveis:
+                partes[posicao] = formatar(valores.get(nome, padrao), tamanho)
+            return ''.join(partes)
+        return renderizar
+
+def _brancos(tamanho):
+    return (None, tamanho, 'A', '')
+
+def _zeros(tamanho):
+    return (None, tamanho, 'N', 0)
+
+CNAB240_HEADER_ARQUIVO = Registro(240, [
+    ('banco', 3, 'N', 0), (None, 4, 'N', 0), (None, 1, 'N', 0), _brancos(9),
+    ('tipo_inscricao', 1, 'N', 2), ('cnpj', 14, 'N', 0), ('convenio', 20, 'A', ''),
+    ('agencia', 5, 'N', 0), ('agencia_dv', 1, 'A', ''), ('conta', 12, 'N', 0), ('conta_dv', 1, 'A', ''),
+    ('agencia_conta_dv', 1, 'A', ''), ('nome', 30, 'A', ''), ('nome_banco', 30, 'A', ''), _brancos(10),
+    (None, 1, 'N', 1), ('gerado_em', 8, 'D8', None), ('hora', 6, 'N', 0), ('nsa', 6, 'N', 0),
+    (None, 3, 'N', 103), _zeros(5), _brancos(20), _brancos(20), _brancos(29),
+])
+CNAB240_HEADER_LOTE = Registro(240, [
+    ('banco', 3, 'N', 0), ('lote', 4, 'N', 1), (None, 1, 'N', 1), (None, 1, 'A', 'R'), (None, 2, 'N', 1),
+    _brancos(2), (None, 3, 'N', 60), _brancos(1), ('tipo_inscricao', 1, 'N', 2), ('cnpj', 15, 'N', 0),
+    ('convenio', 20, 'A', ''), ('agencia', 5, 'N', 0), ('agencia_dv', 1, 'A', ''), ('conta', 12, 'N', 0),
+    ('conta_dv', 1, 'A', ''), ('agencia_conta_dv', 1, 'A', ''), ('nome', 30, 'A', ''),
+    ('mensagem_1', 40, 'A', ''), ('mensagem_2', 40, 'A', ''), ('nsa', 8, 'N', 0),
+    ('gerado_em', 8, 'D8', None), _zeros(8), _brancos(33),
+])
+CNAB240_SEGMENTO_P = Registro(240, [
+    ('banco', 3, 'N', 0), ('lote', 4, 'N', 1), (None, 1, 'N', 3), ('sequencial', 5, 'N', 0), (None, 1, 'A', 'P'),
+    _brancos(1), (None, 2, 'N', 1), ('agencia', 5, 'N', 0), ('agencia_dv', 1, 'A', ''), ('conta', 12, 'N', 0),
+    ('conta_dv', 1, 'A', ''), ('agencia_conta_dv', 1, 'A', ''), ('nosso_numero', 20, 'A', ''),
+    ('carteira', 1, 'N', 1), (None, 1, 'N', 1), (None, 1, 'N', 1), (None, 1, 'N', 2), (None, 1, 'N', 2),
+    ('documento', 15, 'A', ''), ('vencimento', 8, 'D8', None), ('valor', 15, 'N', 0), _zeros(5), _brancos(1),
+    ('especie', 2, 'N', 2), (None, 1, 'A', 'N'), ('emissao', 8, 'D8', None), (None, 1, 'N', 3), _zeros(8),
+    _zeros(15), _zeros(1), _zeros(8), _zeros(15), _zeros(15), _zeros(15), ('uso_empresa', 25, 'A', ''),
+    (None, 1, 'N', 3), _zeros(2), _zeros(1), _zeros(3), (None, 2, 'N', 9), _zeros(10), _brancos(1),
+])
+CNAB240_SEGMENTO_Q = Registro(240, [
+    ('banco', 3, 'N', 0), ('lote', 4, 'N', 1), (None, 1, 'N', 3), ('sequencial', 5, 'N', 0), (None, 1, 'A', 'Q'),
+    _brancos(1), (None, 2, 'N', 1), ('pagador_tipo', 1, 'N', 1), ('pagador_documento', 15, 'N', 0),
+    ('pagador_nome', 40, 'A', ''), ('pagador_endereco', 40, 'A', ''), ('pagador_bairro', 15, 'A', ''),
+    ('pagador_cep', 8, 'N', 0), ('pagador_cidade', 15, 'A', ''), ('pagador_uf', 2, 'A', ''),
+    _zeros(1), _zeros(15), _brancos(40), _zeros(3), _brancos(20), _brancos(8),
+])
+CNAB240_TRAILER_LOTE = Registro(240, [
+    ('banco', 3, 'N', 0), ('lote', 4, 'N', 1), (None, 1, 'N', 5), _brancos(9), ('registros', 6, 'N', 0),
+    ('titulos', 6, 'N', 0), ('valor_total', 17, 'N', 0), _brancos(194),
+])
+CNAB240_TRAILER_ARQUIVO = Registro(240, [
+    ('banco', 3, 'N', 0), (None, 4, 'N', 9999), (None, 1, 'N', 9), _brancos(9), ('lotes', 6, 'N', 1),
+    ('registros', 6, 'N', 0), _zeros(6), _brancos(205),
+])
+
+# the record number inside a CNAB 240 batch has five digits: two segments per title
+TITULOS_POR_LOTE_240 = 49999
+
+CNAB400_HEADER = Registro(400, [
+    (None, 1, 'N', 0), (None, 1, 'N', 1), (None, 7, 'A', 'REMESSA'), (None, 2, 'N', 1), (None, 15, 'A', 'COBRANCA'),
+    ('convenio', 20, 'A', ''), ('nome', 30, 'A', ''), ('banco', 3, 'N', 0), ('nome_banco', 15, 'A', ''),
+    ('gerado_em', 6, 'D6', None), _brancos(8), _brancos(2), ('nsa', 7, 'N', 0), _brancos(277), (None, 6, 'N', 1),
+])
+CNAB400_DETALHE = Registro(400, [
+    (None, 1, 'N', 1), ('tipo_inscricao', 2, 'N', 2), ('cnpj', 14, 'N', 0), ('agencia', 4, 'N', 0), _zeros(2),
+    ('conta', 5, 'N', 0), ('conta_dv', 1, 'A', ''), _brancos(4), _zeros(4), ('uso_empresa', 25, 'A', ''),
+    ('nosso_numero', 11, 'N', 0), ('nosso_numero_dv', 1, 'N', 0), _brancos(34), (None, 2, 'N', 1),
+    ('documento', 10, 'A', ''), ('vencimento', 6, 'D6', None), ('valor', 13, 'N', 0), ('banco', 3, 'N', 0),
+    _zeros(5), ('especie', 2, 'N', 2), (None, 1, 'A', 'N'), ('emissao', 6, 'D6', None), _zeros(2), _zeros(2),
+    _zeros(13), _zeros(6), _zeros(13), _zeros(13), _zeros(13), ('pagador_tipo', 2, 'N', 1),
+    ('pagador_documento', 14, 'N', 0), ('pagador_nome', 40, 'A', ''), ('pagador_endereco', 40, 'A', ''),
+    _brancos(12), ('pagador_cep', 8, 'N', 0), _brancos(60), ('sequencial', 6, 'N', 0),
+])
+CNAB400_TRAILER = Registro(400, [(None, 1, 'N', 9), _brancos(393), ('sequencial', 6, 'N', 0)])
+
+def _pagador(documento):
+    texto = str(documento or '')
+    digitos = texto if texto.isdigit() else ''.join(filter(str.isdigit, texto))
+    return (2 if len(digitos) > 11 else 1), int(digitos or 0)
+
+def remessa(layout, cedente, titulos, nsa, gerado_em):
+    """Yield the lines (with CRLF) of a ``layout`` ``'240'`` or ``'400'`` remittance file.
+
+    ``cedente`` holds the beneficiary settings (banco, nome_banco, cnpj,
+    convenio, agencia, agencia_dv, conta, conta_dv, carteira, especie,
+    ...). ``titulos`` is an iterable of dicts with ``nosso_numero`` (int),
+    ``documento``, ``vencimento``, ``valor`` (cents), ``pagador_nome``,
+    ``pagador_documento`` and ``uso_empresa``; it is consumed lazily, one
+    title at a time. Every title is issued on the date of ``gerado_em``.
+    """
+    fixos = {**cedente, 'gerado_em': gerado_em, 'emissao': gerado_em.date(),
+             'hora': int(gerado_em.strftime('%H%M%S')), 'nsa': nsa}
+    if layout == '240':
+        yield from _remessa240(fixos, titulos)
+    elif layout == '400':
+        yield from _remessa400(fixos, titulos)
+    else:
+        raise ValueError(f'layout CNAB desconhecido: {layout}')
+
+SEGMENTO_P_VARIAVEIS = ('sequencial', 'nosso_numero', 'documento', 'vencimento', 'valor', 'uso_empresa')
+SEGMENTO_Q_VARIAVEIS = ('sequencial', 'pagador_tipo', 'pagador_documento', 'pagador_nome')
+DETALHE_400_VARIAVEIS = ('sequencial', 'nosso_numero', 'nosso_numero_dv', 'documento', 'vencimento', 'valor',
+                         'uso_empresa', 'pagador_tipo', 'pagador_documento', 'pagador_nome')
+
+def _remessa240(fixos, titulos):
+    yield CNAB240_HEADER_ARQUIVO.compilar(**fixos)()
+    lote, quantidade, total, registros = 0, 0, 0, 2
+    for titulo in titulos:
+        if quantidade == TITULOS_POR_LOTE_240:
+            yield CNAB240_TRAILER_LOTE.compilar(**fixos, lote=lote, registros=2 * quantidade + 2,
+                                                titulos=quantidade, valor_total=total)()
+            registros += 2 * quantidade + 2
+            quantidade, total = 0, 0
+        if quantidade == 0:
+            lote += 1
+            yield CNAB240_HEADER_LOTE.compilar(**fixos, lote=lote)()
+            segmento_p = CNAB240_SEGMENTO_P.compilar(SEGMENTO_P_VARIAVEIS, **fixos, lote=lote)
+            segmento_q = CNAB240_SEGMENTO_Q.compilar(SEGMENTO_Q_VARIAVEIS, **fixos, lote=lote)
+        numero = titulo['nosso_numero']
+        pagador_tipo, pagador_documento = _pagador(titulo['pagador_documento'])
+        yield segmento_p(sequencial=2 * quantidade + 1, nosso_numero=f'{numero:011d}{modulo11(numero)}',
+                         documento=titulo['documento'], vencimento=titulo['vencimento'], valor=titulo['valor'],
+                         uso_empresa=titulo['uso_empresa'])
+        yield segmento_q(sequencial=2 * quantidade + 2, pagador_tipo=pagador_tipo,
+                         pagador_documento=pagador_documento, pagador_nome=titulo['pagador_nome'])
+        quantidade += 1
+        total += titulo['valor']
+    if quantidade:
+        yield CNAB240_TRAILER_LOTE.compilar(**fixos, lote=lote, registros=2 * quantidade + 2,
+                                            titulos=quantidade, valor_total=total)()
+        registros += 2 * quantidade + 2
+    yield CNAB240_TRAILER_ARQUIVO.compilar(**fixos, lotes=lote, registros=registros)()
+
+def _remessa400(fixos, titulos):
+    yield CNAB400_HEADER.compilar(**fixos)()
+    detalhe = CNAB400_DETALHE.compilar(DETALHE_400_VARIAVEIS, **fixos)
+    sequencial = 1
+    for titulo in titulos:
+        numero = titulo['nosso_numero']
+        pagador_tipo, pagador_documento = _pagador(titulo['pagador_documento'])
+        sequencial += 1
+        yield detalhe(sequencial=sequencial, nosso_numero=numero, nosso_numero_dv=modulo11(numero),
+                      documento=titulo['documento'], vencimento=titulo['vencimento'], valor=titulo['valor'],
+                      uso_empresa=titulo['uso_empresa'], pagador_tipo=pagador_tipo,
+                      pagador_documento=pagador_documento, pagador_nome=titulo['pagador_nome'])
+    yield CNAB400_TRAILER.compilar(sequencial=sequencial + 1)()
+
+# occurrence codes that mean the title was paid (liquidação, liquidação em cartório, após baixa)
+OCORRENCIAS_LIQUIDACAO = frozenset({'06', '15', '17'})
+
+@functools.lru_cache(maxsize=4096)
+def _ler_data(texto):
+    if not texto.strip('0 '):
+        return None
+    if len(texto) == 6:
+        return datetime.strptime(texto, '%d%m%y').date()
+    return datetime.strptime(texto, '%d%m%Y').date()
+
+def _ler_nosso_numero(campo):
+    """The nosso número of ``campo`` (digits followed by the DV), or None when the DV does not check."""
+    campo = campo.strip()
+    if len(campo) < 2 or not campo.isdigit():
+        return None
+    numero = int(campo[:-1])
+    return numero if modulo11(numero) == int(campo[-1]) else None
+
+def retorno(linhas):
+    """Yield the title occurrences of a CNAB 240 or 400 return (retorno) file.
+
+    ``linhas`` is any iterable of text lines, read lazily; the layout is
+    told apart by line length. Every occurrence is a dict with ``linha``
+    (1-based line number), ``nosso_numero`` (int, None when unreadable),
+    ``ocorrencia`` (the bank's two-digit code), ``valor_pago`` (cents)
+    and ``data_pagamento`` (the credit date, or the occurrence date when
+    the bank leaves it blank). In CNAB 240 the segment T and U pair of a
+    title makes one occurrence.
+    """
+    titulo = None
+    for numero_linha, linha in enumerate(linhas, start=1):
+        linha = linha.rstrip('\r\n')
+        if len(linha) == 240:
+            if linha[7] != '3':
+                continue
+            if linha[13] == 'T':
+                titulo = {'linha': numero_linha, 'nosso_numero': _ler_nosso_numero(linha[37:57]),
+                          'ocorrencia': linha[15:17]}
+            elif linha[13] == 'U' and titulo is not None:
+                titulo['valor_pago'] = int(linha[77:92] or 0)
+                titulo['data_pagamento'] = _ler_data(linha[145:153]) or _ler_data(linha[137:145])
+                yield titulo
+                titulo = None
+        elif len(linha) == 400:
+            if linha[0] != '1':
+                continue
+            yield {'linha': numero_linha, 'nosso_numero': _ler_nosso_numero(linha[62:74]),
+                   'ocorrencia': linha[108:110], 'valor_pago': int(linha[253:266] or 0),
+                   'data_pagamento': _ler_data(linha[295:301]) or _ler_data(linha[110:116])}
+        elif linha.strip():
+            raise ValueError(f'linha {numero_linha}: {len(linha)} posições, esperado 240 ou 400')
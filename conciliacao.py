@@ -0,0 +1,193 @@
+"""Bank statement reading and payment matching for reconciliation.
+
+No database access: ``ler_extrato()`` turns an OFX or CSV statement into
+credit entries, and ``Conciliador`` proposes an open installment for each
+of them. The installments are indexed once per statement by amount (kept
+sorted by due date for the date window), by payer CPF/CNPJ and by
+contract number, so every entry is matched with a few dict lookups and a
+bisect instead of a scan.
+"""
+from collections import defaultdict
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+import bisect
+import functools
+import csv
+import re
+
+RE_DOCUMENTO = re.compile(r'(?<!\d)(\d{3}\.?\d{3}\.?\d{3}-?\d{2}|\d{2}\.?\d{3}\.?\d{3}/?\d{4}-?\d{2})(?!\d)')
+RE_TOKEN = re.compile(r'[0-9A-Z](?:[0-9A-Z./-]*[0-9A-Z])?')
+RE_TAG_OFX = re.compile(r'<(/?)(\w+)>([^<]*)')
+RE_NAO_DIGITO = re.compile(r'\D')
+
+def so_digitos(texto):
+    return RE_NAO_DIGITO.sub('', texto or '')
+
+def identificadores(descricao):
+    """The CPF/CNPJ digits and the upper-cased words of a statement description."""
+    texto = (descricao or '').upper()
+    return {so_digitos(documento) for documento in RE_DOCUMENTO.findall(texto)}, set(RE_TOKEN.findall(texto))
+
+def centavos(texto):
+    """``'1.234,56'``, ``'1234.56'`` or ``'-12,3'`` as integer cents."""
+    texto = texto.strip().replace(' ', '').replace('R$', '')
+    if ',' in texto:
+        texto = texto.replace('.', '').replace(',', '.')
+    try:
+        return int((Decimal(texto) * 100).to_integral_value(ROUND_HALF_UP))
+    except InvalidOperation:
+        raise ValueError(f'valor inválido: {texto!r}') from None
+
+def _lancamento(linha, data, valor, descricao, documento):
+    documentos, palavras = identificadores(descricao)
+    return {'linha': linha, 'data': data, 'valor': valor, 'descricao': descricao, 'documento': documento,
+            'documentos': documentos, 'palavras': palavras}
+
+def ler_ofx(linhas):
+    """Yield the credits of an OFX statement (SGML or XML, one tag per line or not)."""
+    transacao = None
+
+    def fechar():
+        valor = centavos(transacao.get('TRNAMT', '0'))
+        if valor > 0:
+            if 'DTPOSTED' not in transacao:
+                raise ValueError(f"linha {transacao['linha']}: transação sem DTPOSTED")
+            return _lancamento(transacao['linha'], datetime.strptime(transacao['DTPOSTED'][:8], '%Y%m%d').date(),
+                               valor, ' '.join(filter(None, (transacao.get('NAME'), transacao.get('MEMO')))),
+                               transacao.get('FITID'))
+
+    for numero_linha, linha in enumerate(linhas, start=1):
+        for fechamento, tag, conteudo in RE_TAG_OFX.findall(linha):
+            tag = tag.upper()
+            if tag == 'STMTTRN':
+                if transacao is not None and (lancamento := fechar()):
+                    yield lancamento
+                transacao = None if fechamento else {'linha': numero_linha}
+            elif transacao is not None and not fechamento and conteudo.strip():
+                transacao[tag] = conteudo.strip()
+    if transacao is not None and (lancamento := fechar()):
+        yield lancamento
+
+COLUNAS_CSV = {
+    'data': 'data', 'date': 'data', 'data lançamento': 'data', 'data lancamento': 'data',
+    'valor': 'valor', 'value': 'valor', 'amount': 'valor', 'crédito': 'valor', 'credito': 'valor',
+    'descrição': 'descricao', 'descricao': 'descricao', 'histórico': 'descricao', 'historico': 'descricao',
+    'memo': 'descricao', 'documento': 'documento', 'id': 'documento', 'fitid': 'documento',
+}
+
+@functools.lru_cache(maxsize=4096)
+def _ler_data(texto):
+    texto = texto.strip()
+    for formato in ('%d/%m/%Y', '%Y-%m-%d', '%d/%m/%y'):
+        try:
+            return datetime.strptime(texto, formato).date()
+        except ValueError:
+            pass
+    raise ValueError(f'data inválida: {texto!r}')
+
+def ler_csv(linhas):
+    """Yield the credits of a CSV statement with data, valor and descrição columns (``;`` or ``,``)."""
+    linhas = iter(linhas)
+    cabecalho = next(linhas, '')
+    leitor = csv.reader(linhas, delimiter=';' if ';' in cabecalho else ',')
+    indices = {}
+    for indice, rotulo in enumerate(next(csv.reader([cabecalho], delimiter=leitor.dialect.delimiter), [])):
+        campo = COLUNAS_CSV.get(rotulo.strip().lower())
+        if campo:
+            indices.setdefault(campo, indice)
+    if 'data' not in indices or 'valor' not in indices:
+        raise ValueError('o extrato CSV precisa das colunas data e valor')
+    for numero_linha, campos in enumerate(leitor, start=2):
+        if not ''.join(campos).strip():
+            continue
+        try:
+            valor = centavos(campos[indices['valor']])
+            if valor > 0:
+                yield _lancamento(numero_linha, _ler_data(campos[indices['data']]), valor,
+                                  *(campos[indices[campo]].strip() if campo in indices else None
+                                    for campo in ('descricao', 'documento')))
+        except (ValueError, IndexError) as erro:
+            raise ValueError(f'linha {numero_linha}: {erro}') from None
+
+def ler_extrato(linhas, nome):
+    """Credits of an OFX (by extension) or CSV statement."""
+    return ler_ofx(linhas) if nome.lower().endswith('.ofx') else ler_csv(linhas)
+
+class Conciliador:
+    """Proposes, for each statement credit, one open installment it pays.
+
+    Load the payers with ``adicionar_contrato`` and the open installments
+    with ``adicionar_parcela``, then call ``propor`` once per credit. An
+    installment is proposed at most once. A credit whose description
+    names a known CPF/CNPJ or contract number is matched to that
+    contract's installment of the same amount due closest to the payment
+    date; any other credit is matched by amount alone, and only when
+    exactly one installment of that amount falls due within
+    ``janela_dias`` of the payment.
+    """
+
+    def __init__(self, janela_dias=5):
+        self.janela = timedelta(days=janela_dias)
+        self.por_valor = defaultdict(list)
+        self.por_contrato = defaultdict(list)
+        self.por_documento = defaultdict(set)
+        self.por_numero = defaultdict(set)
+        self.propostas = set()
+        self._ordenado = True
+
+    def adicionar_contrato(self, contrato_id, documento, numero):
+        if documento and (digitos := so_digitos(documento)):
+            self.por_documento[digitos].add(contrato_id)
+        if numero:
+            self.por_numero[numero.strip().upper()].add(contrato_id)
+
+    def adicionar_parcela(self, chave, contrato_id, vencimento, valor):
+        """``chave`` identifies the installment in the proposals; add each installment once."""
+        self.por_valor[valor].append((vencimento, chave))
+        self.por_contrato[contrato_id].append((vencimento, valor, chave))
+        self._ordenado = False
+
+    def _ordenar(self):
+        for lista in self.por_valor.values():
+            lista.sort()
+        self._ordenado = True
+
+    def contratos(self, lancamento):
+        """Ids of the contracts named in the credit's description, and how they were found."""
+        contratos = set()
+        for documento in lancamento['documentos']:
+            contratos |= self.por_documento.get(documento, set())
+        if contratos:
+            return contratos, 'cpf'
+        for palavra in lancamento['palavras']:
+            contratos |= self.por_numero.get(palavra, set())
+        return contratos, 'numero'
+
+    def propor(self, lancamento):
+        """``(chave, criterio)`` of the installment proposed for ``lancamento``, or None."""
+        if not self._ordenado:
+            self._ordenar()
+        data, valor = lancamento['data'], lancamento['valor']
+        contratos, criterio = self.contratos(lancamento)
+        if contratos:
+            candidatas = [(abs(vencimento - data), chave) for contrato_id in contratos
+                          for vencimento, valor_parcela, chave in self.por_contrato.get(contrato_id, ())
+                          if valor_parcela == valor and chave not in self.propostas]
+            if not candidatas:
+                return None
+            chave = min(candidatas)[1]
+        else:
+            criterio = 'valor'
+            parcelas = self.por_valor.get(valor, ())
+            inicio = bisect.bisect_left(parcelas, (data - self.janela,))
+            fim = bisect.bisect_left(parcelas, (data + self.janela + timedelta(days=1),))
+            chave = None
+            for indice in range(inicio, fim):
+                if parcelas[indice][1] not in self.propostas:
+                    if chave is not None:
+                        return None
+                    chave = parcelas[indice][1]
+            if chave is None:
+                return None
+        self.propostas.add(chave)
+        return chave, criterio
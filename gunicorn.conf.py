@@ -0,0 +1,28 @@
+"""Gunicorn settings for production; every value can be overridden from the environment."""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_class = 'gthread'
+# load the app (and run migrations) once in the master, then fork the workers
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+# on SIGTERM workers get this long to finish in-flight requests
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+accesslog = '-'
+
+def post_fork(server, worker):
+    # a preloaded master may have opened SQLite connections; never share them
+    from app import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+def worker_exit(server, worker):
+    from app import app, db, encerrar_exportacoes
+    encerrar_exportacoes()
+    with app.app_context():
+        db.engine.dispose()
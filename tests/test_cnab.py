@@ -0,0 +1,116 @@
+"""Field positions of the CNAB remittance files and their round trip through ``cnab.retorno()``."""
+from datetime import date, datetime
+
+import pytest
+
+import cnab
+
+CEDENTE = {
+    'banco': 1, 'nome_banco': 'BANCO DO BRASIL', 'cnpj': 12345678000195, 'nome': 'Cooperativa Teste',
+    'convenio': '1234567', 'agencia': 1234, 'agencia_dv': '5', 'conta': 67890, 'conta_dv': '1',
+    'carteira': 1, 'especie': 2,
+}
+TITULOS = [
+    {'nosso_numero': 1, 'documento': 'C-1/1', 'vencimento': date(2024, 3, 10), 'valor': 12345,
+     'pagador_nome': 'José da Silva', 'pagador_documento': '123.456.789-09', 'uso_empresa': '1-1'},
+    {'nosso_numero': 98765432101, 'documento': 'C-2/3', 'vencimento': date(2024, 12, 31), 'valor': 1,
+     'pagador_nome': 'Empresa Ltda', 'pagador_documento': '12.345.678/0001-95', 'uso_empresa': '2-3'},
+]
+GERADO_EM = datetime(2024, 3, 1, 8, 30, 15)
+PAGO_EM = date(2024, 3, 11)
+
+def gerar(layout):
+    return list(cnab.remessa(layout, CEDENTE, iter(TITULOS), 7, GERADO_EM))
+
+def test_modulo11():
+    assert cnab.modulo11(1) == 9
+    assert cnab.modulo11(261533) == 9
+    # remainders 0 and 1 give 11 and 10, written as 0
+    assert cnab.modulo11(6) == 0
+    assert cnab.modulo11(5) == 1
+
+def test_remessa_240_posicoes():
+    linhas = gerar('240')
+    assert all(len(linha) == 242 and linha.endswith('\r\n') for linha in linhas)
+    assert [linha[7] for linha in linhas] == ['0', '1', '3', '3', '3', '3', '5', '9']
+    assert linhas[0][157:163] == '000007'
+    assert linhas[0][143:151] == '01032024'
+    segmentos_p = [linha for linha in linhas if linha[7] == '3' and linha[13] == 'P']
+    for linha, titulo in zip(segmentos_p, TITULOS, strict=True):
+        numero = titulo['nosso_numero']
+        assert linha[37:57] == f'{numero:011d}{cnab.modulo11(numero)}'.ljust(20)
+        assert linha[62:77] == titulo['documento'].ljust(15)
+        assert linha[77:85] == titulo['vencimento'].strftime('%d%m%Y')
+        assert linha[85:100] == f"{titulo['valor']:015d}"
+    assert [linha[8:13] for linha in linhas[2:6]] == ['00001', '00002', '00003', '00004']
+    segmento_q = linhas[3]
+    assert segmento_q[13] == 'Q'
+    assert segmento_q[17:33] == '1000012345678909'
+    assert segmento_q[33:73] == 'JOSE DA SILVA'.ljust(40)
+    trailer_lote, trailer_arquivo = linhas[-2], linhas[-1]
+    assert trailer_lote[17:23] == '000006'
+    assert trailer_lote[23:29] == '000002'
+    assert trailer_lote[29:46] == f'{12346:017d}'
+    assert trailer_arquivo[17:23] == '000001'
+    assert trailer_arquivo[23:29] == '000008'
+
+def test_remessa_400_posicoes():
+    linhas = gerar('400')
+    assert all(len(linha) == 402 and linha.endswith('\r\n') for linha in linhas)
+    assert [linha[0] for linha in linhas] == ['0', '1', '1', '9']
+    assert linhas[0][1:9] == '1REMESSA'
+    assert linhas[0][94:100] == '010324'
+    for linha, titulo in zip(linhas[1:3], TITULOS, strict=True):
+        numero = titulo['nosso_numero']
+        assert linha[62:73] == f'{numero:011d}'
+        assert linha[73] == str(cnab.modulo11(numero))
+        assert linha[110:120] == titulo['documento'].ljust(10)
+        assert linha[120:126] == titulo['vencimento'].strftime('%d%m%y')
+        assert linha[126:139] == f"{titulo['valor']:013d}"
+    assert linhas[1][218:220] == '01'
+    assert linhas[2][218:220] == '02'
+    assert [linha[394:400] for linha in linhas] == ['000001', '000002', '000003', '000004']
+
+def retorno_240(linha_p, valor, data):
+    """The T and U segments a bank returns for the title of ``linha_p``, liquidated."""
+    segmento_t = linha_p[:13] + 'T' + linha_p[14:15] + '06' + linha_p[17:240]
+    segmento_u = (linha_p[:13] + 'U' + ' ' + '06' + '0' * 60 + f'{valor:015d}' + '0' * 45
+                  + data.strftime('%d%m%Y') + data.strftime('%d%m%Y')).ljust(240)
+    return [segmento_t, segmento_u]
+
+def retorno_400(linha, valor, data):
+    """The detail record a bank returns for the title of ``linha``, liquidated."""
+    linha = linha.rstrip('\r\n')
+    return linha[:108] + '06' + linha[110:253] + f'{valor:013d}' + linha[266:295] + data.strftime('%d%m%y') + linha[301:]
+
+def test_ida_e_volta_240():
+    linhas = gerar('240')
+    retorno = [linhas[0], linhas[1]]
+    for linha in linhas:
+        if linha[7] == '3' and linha[13] == 'P':
+            retorno += retorno_240(linha.rstrip('\r\n'), 12345, PAGO_EM)
+    retorno += linhas[-2:]
+    ocorrencias = list(cnab.retorno(retorno))
+    assert [o['nosso_numero'] for o in ocorrencias] == [titulo['nosso_numero'] for titulo in TITULOS]
+    assert all(o['ocorrencia'] in cnab.OCORRENCIAS_LIQUIDACAO for o in ocorrencias)
+    assert all(o['valor_pago'] == 12345 and o['data_pagamento'] == PAGO_EM for o in ocorrencias)
+
+def test_ida_e_volta_400():
+    linhas = gerar('400')
+    retorno = [linhas[0]] + [retorno_400(linha, 999, PAGO_EM) for linha in linhas[1:-1]] + [linhas[-1]]
+    ocorrencias = list(cnab.retorno(retorno))
+    assert [o['nosso_numero'] for o in ocorrencias] == [titulo['nosso_numero'] for titulo in TITULOS]
+    assert [o['linha'] for o in ocorrencias] == [2, 3]
+    assert all(o['ocorrencia'] == '06' and o['valor_pago'] == 999 and o['data_pagamento'] == PAGO_EM
+               for o in ocorrencias)
+
+def test_retorno_rejeita_digito_errado():
+    linha = retorno_400(gerar('400')[1], 100, PAGO_EM)
+    digito = int(linha[73])
+    errada = linha[:73] + str((digito + 1) % 10) + linha[74:]
+    assert next(cnab.retorno([errada]))['nosso_numero'] is None
+
+def test_remessa_sem_titulos_e_layout_desconhecido():
+    assert len(list(cnab.remessa('400', CEDENTE, [], 1, GERADO_EM))) == 2
+    with pytest.raises(ValueError):
+        list(cnab.remessa('999', CEDENTE, TITULOS, 1, GERADO_EM))